@@ -2,26 +2,41 @@
 """
 HotQuiz – App principal
 """
-from flask import Flask, render_template, session, redirect, url_for, flash, request, send_file, jsonify
+from flask import Flask, render_template, session, redirect, url_for, flash, request, send_file, jsonify, Response, g
 from flask_socketio import SocketIO, send, emit, join_room, leave_room
 from dotenv import load_dotenv
 load_dotenv()
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
 from uuid import uuid4
 
 import os
-from pymongo import MongoClient
-from datetime import timedelta, datetime
+from pymongo import MongoClient, ReturnDocument, UpdateOne, IndexModel, ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError, OperationFailure, BulkWriteError
+from datetime import timedelta, datetime, timezone
 from werkzeug.security import generate_password_hash, check_password_hash
 import re
-from collections import Counter
+from collections import Counter, OrderedDict
 import hashlib
 import time
+import threading
+import queue
+import atexit
+import tempfile
+import click
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from urllib.parse import unquote
 import pusher
-from gridfs import GridFS
+from gridfs import GridFS, NoFile
 import base64
+import json
 import certifi
 from bson.errors import InvalidId
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # sin Pillow se guardan solo los originales
+    Image = None
 from bson.objectid import ObjectId
 # ---------------------------------------------------------------------------
 # Config Flask + Mongo
@@ -29,7 +44,14 @@ from bson.objectid import ObjectId
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY", "clave_secreta_hotquiz")
 app.permanent_session_lifetime = timedelta(days=30) # duración de la cookie
-socketio = SocketIO(app)
+# Tiempo real: "pusher" (servicio externo) o "socketio" (gateway propio en esta app).
+TIEMPO_REAL = os.getenv("TIEMPO_REAL", "pusher")
+# Con varios workers o nodos los emits pasan por una cola de mensajes (redis://, amqp://,
+# kafka://) para llegar a clientes conectados a otro proceso; sin ella el reparto es en
+# memoria dentro del proceso (un solo nodo y pruebas).
+socketio = SocketIO(app,
+                    message_queue=os.getenv("SOCKETIO_MESSAGE_QUEUE") or None,
+                    channel=os.getenv("SOCKETIO_CANAL", "hotquiz"))
 client = MongoClient(os.getenv("MONGODB_URI"), tlsCAFile=certifi.where())
 db = client.hotquiz
 fs = GridFS(db)
@@ -52,6 +74,16 @@ donaciones_col = db.donaciones_tokens
 hotreels_col = db.hotreels
 retiros_col = db.retiros
 mensajes_col = db.mensajes
+cubetas_chat_col = db.cubetas_chat
+salas_col = db.salas
+ingestas_col = db.ingestas
+media_refs_col = db.media_refs
+subidas_col = db.subidas
+ranking_col = db.ranking
+cubetas_col = db.cubetas
+seguimientos_col = db.seguimientos
+votos_retos_col = db.votos_retos
+notificaciones_col = db.notificaciones
 
 # Configuración de Pusher (Chat)
 pusher_client = pusher.Pusher(
@@ -59,8 +91,146 @@ pusher_client = pusher.Pusher(
     key=os.getenv("PUSHER_KEY", "24aebba9248c791c8722"),
     secret=os.getenv("PUSHER_SECRET", "84d7288e7578267c3f6e"),
     cluster=os.getenv("PUSHER_CLUSTER", "mt1"),
-    ssl=True
+    ssl=True,
+    # el backend por defecto (requests) usa una Session: la conexión TLS se reutiliza
+    timeout=int(os.getenv("PUSHER_TIMEOUT", 5))
+)
+
+# ---------------------------------------------------------------------------
+# Despacho de eventos en tiempo real (fuera del request)
+# ---------------------------------------------------------------------------
+# Los requests solo encolan; un hilo junta hasta EVENTOS_POR_LOTE eventos (el máximo
+# de trigger_batch en Pusher) y los manda en una sola llamada, con reintentos.
+# Si la cola se llena el evento se descarta y se cuenta: el mensaje ya está guardado
+# y el cliente lo verá al recargar el historial.
+EVENTOS_MAX_COLA = int(os.getenv("EVENTOS_MAX_COLA", 1000))
+EVENTOS_POR_LOTE = 10
+# Segundos que el hilo espera para completar un lote antes de mandarlo
+EVENTOS_ESPERA = float(os.getenv("EVENTOS_ESPERA", 0.05))
+EVENTOS_REINTENTOS = int(os.getenv("EVENTOS_REINTENTOS", 3))
+# Segundos que el proceso espera al salir para mandar lo que quede en la cola
+EVENTOS_ESPERA_SALIDA = float(os.getenv("EVENTOS_ESPERA_SALIDA", 5))
+
+
+class DespachadorEventos:
+    """Cola acotada de eventos hacia un transporte con trigger_batch(eventos).
+    El transporte es intercambiable (pusher_client en producción, uno falso en pruebas)."""
+
+    def __init__(self, transporte, max_cola=EVENTOS_MAX_COLA, por_lote=EVENTOS_POR_LOTE,
+                 espera=EVENTOS_ESPERA, reintentos=EVENTOS_REINTENTOS, backoff=0.5):
+        self.transporte = transporte
+        self.por_lote = por_lote
+        self.espera = espera
+        self.reintentos = reintentos
+        self.backoff = backoff
+        self._cola = queue.Queue(maxsize=max_cola)
+        self._lock = threading.Lock()
+        self._hilo = None
+        self.contadores = {"encolados": 0, "enviados": 0, "lotes": 0,
+                           "reintentos": 0, "descartados": 0, "fallidos": 0}
+
+    def _sumar(self, contador, n=1):
+        with self._lock:
+            self.contadores[contador] += n
+            return self.contadores[contador]
+
+    def encolar(self, canal, evento, datos):
+        """Agrega un evento sin bloquear. Devuelve False si la cola está llena."""
+        self._arrancar()
+        try:
+            self._cola.put_nowait({"channel": canal, "name": evento, "data": datos})
+        except queue.Full:
+            descartados = self._sumar("descartados")
+            if descartados % 100 == 1:
+                print(f"Error: cola de eventos llena, descartados: {descartados}")
+            return False
+        self._sumar("encolados")
+        return True
+
+    def _arrancar(self):
+        if self._hilo is None or not self._hilo.is_alive():
+            with self._lock:
+                if self._hilo is None or not self._hilo.is_alive():
+                    self._hilo = threading.Thread(target=self._bucle, name="eventos", daemon=True)
+                    self._hilo.start()
+
+    def _tomar_lote(self):
+        lote = [self._cola.get()]
+        limite = time.monotonic() + self.espera
+        while len(lote) < self.por_lote:
+            restante = limite - time.monotonic()
+            try:
+                lote.append(self._cola.get(timeout=restante) if restante > 0 else self._cola.get_nowait())
+            except queue.Empty:
+                break
+        return lote
+
+    def _enviar(self, lote):
+        for intento in range(self.reintentos + 1):
+            try:
+                self.transporte.trigger_batch(lote)
+                self._sumar("enviados", len(lote))
+                self._sumar("lotes")
+                return True
+            except (pusher.errors.PusherBadRequest, pusher.errors.PusherBadAuth,
+                    pusher.errors.PusherForbidden) as e:
+                # reintentar no arregla un lote rechazado
+                print(f"Error: Pusher rechazó un lote de {len(lote)} eventos: {e}")
+                break
+            except Exception as e:
+                if intento == self.reintentos:
+                    print(f"Error enviando {len(lote)} eventos tras {intento + 1} intentos: {e}")
+                    break
+                self._sumar("reintentos")
+                time.sleep(self.backoff * 2 ** intento)
+        self._sumar("fallidos", len(lote))
+        return False
+
+    def _bucle(self):
+        while True:
+            lote = self._tomar_lote()
+            try:
+                self._enviar(lote)
+            finally:
+                for _ in lote:
+                    self._cola.task_done()
+
+    def vaciar(self, timeout=None):
+        """Espera a que se procese todo lo encolado (pruebas y apagado), como mucho
+        `timeout` segundos. Devuelve False si quedaron eventos sin procesar."""
+        if self._hilo is None or not self._hilo.is_alive():
+            return self._cola.unfinished_tasks == 0
+        limite = None if timeout is None else time.monotonic() + timeout
+        with self._cola.all_tasks_done:
+            while self._cola.unfinished_tasks:
+                restante = None if limite is None else limite - time.monotonic()
+                if restante is not None and restante <= 0:
+                    print(f"Error: quedaron {self._cola.unfinished_tasks} eventos sin mandar")
+                    return False
+                self._cola.all_tasks_done.wait(restante)
+        return True
+
+    def estadisticas(self):
+        with self._lock:
+            return {**self.contadores, "en_cola": self._cola.qsize()}
+
+
+class TransporteSocketIO:
+    """Transporte del despachador que emite por el gateway de Flask-SocketIO."""
+
+    def __init__(self, sio):
+        self.sio = sio
+
+    def trigger_batch(self, eventos):
+        for evento in eventos:
+            self.sio.emit(evento["name"], evento["data"], to=evento["channel"])
+
+
+despachador_eventos = DespachadorEventos(
+    TransporteSocketIO(socketio) if TIEMPO_REAL == "socketio" else pusher_client
 )
+# el hilo es daemon: sin esto lo encolado justo antes de salir se perdería
+atexit.register(despachador_eventos.vaciar, EVENTOS_ESPERA_SALIDA)
 
 # ---------------------------------------------------------------------------
 # Archivos multimedia
@@ -76,20 +246,1192 @@ ALLOWED_VIDEO = {"mp4", "mov", "avi", "wmv", "flv", "webm"}
 def allowed_file(filename, allowed_extensions):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in allowed_extensions
 
+# Tamaño de cada bloque que se envía al cliente (igual al chunk por defecto de GridFS)
+MEDIA_BLOQUE = 255 * 1024
+# Vigencia de la caché del navegador para archivos direccionados por id (1 año)
+MEDIA_MAX_AGE = 365 * 24 * 3600
+
+def _fecha_subida(archivo):
+    """Fecha de subida del archivo de GridFS en UTC, sin microsegundos (precisión HTTP)."""
+    fecha = archivo.upload_date.replace(microsecond=0)
+    if fecha.tzinfo is None:
+        fecha = fecha.replace(tzinfo=timezone.utc)
+    return fecha
+
+def etag_gridfs(archivo):
+    """ETag fuerte a partir de los metadatos de GridFS (los archivos nunca se reescriben)."""
+    base = f"{archivo._id}:{archivo.md5 or ''}:{archivo.upload_date.isoformat()}:{archivo.length}"
+    return hashlib.sha1(base.encode("utf-8")).hexdigest()
+
+def _rango_vigente(archivo, etag):
+    """Evalúa If-Range: el Range solo se respeta si el validador sigue vigente."""
+    if "If-Range" not in request.headers:
+        return True
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return if_range.date == _fecha_subida(archivo)
+    return False
+
+def _sin_cambios(archivo, etag):
+    """True si el cliente ya tiene esta versión (If-None-Match / If-Modified-Since)."""
+    if "If-None-Match" in request.headers:
+        return request.if_none_match.contains_weak(etag)
+    desde = request.if_modified_since
+    return desde is not None and _fecha_subida(archivo) <= desde
+
+def _cabeceras_cache(resp, archivo, etag, privado):
+    """Los ids de GridFS son inmutables: se pueden cachear por un año."""
+    resp.set_etag(etag)
+    resp.last_modified = _fecha_subida(archivo)
+    resp.headers["Cache-Control"] = (
+        f"{'private' if privado else 'public'}, max-age={MEDIA_MAX_AGE}, immutable"
+    )
+    return resp
+
+def _leer_rango(archivo, inicio, longitud):
+    """Genera los bytes pedidos leyendo de GridFS bloque a bloque."""
+    try:
+        archivo.seek(inicio)
+        restante = longitud
+        while restante > 0:
+            bloque = archivo.read(min(MEDIA_BLOQUE, restante))
+            if not bloque:
+                break
+            restante -= len(bloque)
+            yield bloque
+    finally:
+        archivo.close()
+
+def responder_gridfs(archivo, download_name=None, privado=False):
+    """Sirve un archivo de GridFS en streaming, con soporte de Range/If-Range (206)
+    y validadores de caché (304 sin leer fs.chunks)."""
+    etag = etag_gridfs(archivo)
+    if _sin_cambios(archivo, etag):
+        archivo.close()
+        resp = Response(status=304)
+        if "w" in request.args:
+            resp.vary.add("Accept")
+        return _cabeceras_cache(resp, archivo, etag, privado)
+
+    archivo = cachear_archivo(archivo)
+    total = archivo.length
+    inicio, fin, status = 0, total, 200
+
+    rango = request.range if _rango_vigente(archivo, etag) else None
+    if rango is not None and len(rango.ranges) == 1:
+        limites = rango.range_for_length(total)
+        if limites is None:
+            archivo.close()
+            resp = Response(status=416)
+            resp.headers["Content-Range"] = f"bytes */{total}"
+            resp.headers["Accept-Ranges"] = "bytes"
+            return resp
+        inicio, fin = limites
+        status = 206
+
+    resp = Response(
+        _leer_rango(archivo, inicio, fin - inicio),
+        status=status,
+        mimetype=archivo.content_type or "application/octet-stream",
+        direct_passthrough=True
+    )
+    resp.content_length = fin - inicio
+    resp.headers["Accept-Ranges"] = "bytes"
+    if status == 206:
+        resp.headers["Content-Range"] = f"bytes {inicio}-{fin - 1}/{total}"
+    if download_name:
+        resp.headers.set("Content-Disposition", "inline", filename=download_name)
+    if "w" in request.args:
+        resp.vary.add("Accept")
+    return _cabeceras_cache(resp, archivo, etag, privado)
+
+# ---------------------------------------------------------------------------
+# Caché LRU en memoria para archivos pequeños de GridFS (avatares, fotos, chat)
+# ---------------------------------------------------------------------------
+class ArchivoEnMemoria:
+    """Copia en memoria de un GridOut con la interfaz que usa responder_gridfs."""
+
+    def __init__(self, archivo, datos):
+        self._id = archivo._id
+        self.md5 = archivo.md5
+        self.upload_date = archivo.upload_date
+        self.length = archivo.length
+        self.content_type = archivo.content_type
+        self.filename = archivo.filename
+        self.metadata = archivo.metadata
+        self.datos = datos
+        self._buffer = BytesIO(datos)
+
+    def seek(self, pos):
+        return self._buffer.seek(pos)
+
+    def read(self, size=-1):
+        return self._buffer.read(size)
+
+    def close(self):
+        pass
+
+    def copia(self):
+        """Devuelve una copia con su propio cursor (los datos se comparten)."""
+        return ArchivoEnMemoria(self, self.datos)
+
+
+class CacheMedia:
+    """LRU acotada por bytes. Los ids de GridFS son de una sola escritura, así que
+    solo hay que invalidar cuando un archivo se borra o deja de usarse."""
+
+    def __init__(self, max_bytes, max_objeto):
+        self.max_bytes = max_bytes
+        self.max_objeto = max_objeto
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, file_id):
+        with self._lock:
+            item = self._items.get(file_id)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(file_id)
+            self.hits += 1
+            return item.copia()
+
+    def put(self, file_id, item):
+        tam = len(item.datos)
+        if tam > self.max_objeto or tam > self.max_bytes:
+            return
+        with self._lock:
+            anterior = self._items.pop(file_id, None)
+            if anterior is not None:
+                self.bytes -= len(anterior.datos)
+            self._items[file_id] = item
+            self.bytes += tam
+            while self.bytes > self.max_bytes:
+                _, viejo = self._items.popitem(last=False)
+                self.bytes -= len(viejo.datos)
+
+    def invalidar(self, file_id):
+        with self._lock:
+            item = self._items.pop(str(file_id), None)
+            if item is not None:
+                self.bytes -= len(item.datos)
+
+    def estadisticas(self):
+        with self._lock:
+            return {
+                "objetos": len(self._items),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+cache_media = CacheMedia(
+    max_bytes=int(os.getenv("MEDIA_CACHE_BYTES", 64 * 1024 * 1024)),
+    max_objeto=int(os.getenv("MEDIA_CACHE_MAX_OBJETO", 512 * 1024))
+)
+
+def obtener_archivo(file_id):
+    """fs.get con caché: los archivos pequeños se sirven desde memoria.
+    En un fallo de caché devuelve el GridOut sin leerlo (solo fs.files), así un 304
+    no toca fs.chunks; responder_gridfs lo cachea si hay que mandar el cuerpo.
+    Lanza InvalidId / NoFile igual que fs.get."""
+    file_id = str(ObjectId(file_id))
+    item = cache_media.get(file_id)
+    if item is not None:
+        return item
+    return fs.get(ObjectId(file_id))
+
+def cachear_archivo(archivo):
+    """Lee a memoria un GridOut pequeño y lo guarda en la caché. Devuelve con qué responder."""
+    if isinstance(archivo, ArchivoEnMemoria) or archivo.length > cache_media.max_objeto:
+        return archivo
+    item = ArchivoEnMemoria(archivo, archivo.read())
+    archivo.close()
+    cache_media.put(str(archivo._id), item)
+    return item.copia()
+
+def eliminar_archivos(file_ids):
+    """Borra en lote archivos de GridFS (y sus derivados) con delete_many sobre
+    fs.files y fs.chunks, y los saca de la caché. Devuelve los bytes liberados."""
+    ids = [ObjectId(f) for f in file_ids]
+    if not ids:
+        return 0
+    liberados, variantes = 0, []
+    for doc in db.fs.files.find({"_id": {"$in": ids}}, {"length": 1, "metadata.variantes": 1}):
+        liberados += doc.get("length", 0)
+        for formatos in ((doc.get("metadata") or {}).get("variantes") or {}).values():
+            variantes.extend(ObjectId(v) for v in formatos.values())
+    if variantes:
+        liberados += sum(d.get("length", 0) for d in db.fs.files.find({"_id": {"$in": variantes}}, {"length": 1}))
+        ids.extend(variantes)
+    db.fs.files.delete_many({"_id": {"$in": ids}})
+    db.fs.chunks.delete_many({"files_id": {"$in": ids}})
+    for file_id in ids:
+        cache_media.invalidar(file_id)
+    return liberados
+
+def eliminar_archivo(file_id):
+    """Borra un archivo de GridFS (y sus derivados) y lo saca de la caché."""
+    eliminar_archivos([file_id])
+
+# ---------------------------------------------------------------------------
+# Derivados de imagen (miniaturas en WebP/JPEG generadas al subir)
+# ---------------------------------------------------------------------------
+ANCHOS_DERIVADOS = (64, 320, 1080)
+FORMATOS_DERIVADOS = {"webp": "image/webp", "jpeg": "image/jpeg"}
+
+def generar_derivados(datos, nombre_base):
+    """Crea versiones redimensionadas de la imagen y las guarda en GridFS.
+    Devuelve {"<ancho>": {"webp": id, "jpeg": id}}; vacío si no aplica."""
+    if Image is None:
+        return {}
+    try:
+        original = Image.open(BytesIO(datos))
+        if getattr(original, "is_animated", False):
+            return {}  # los GIF animados se sirven tal cual
+        original = ImageOps.exif_transpose(original).convert("RGB")
+    except Exception as e:
+        print(f"No se pudieron generar derivados: {e}")
+        return {}
+
+    variantes = {}
+    for ancho in ANCHOS_DERIVADOS:
+        if ancho >= original.width:
+            continue
+        alto = max(1, round(original.height * ancho / original.width))
+        copia = original.resize((ancho, alto), Image.LANCZOS)
+        formatos = {}
+        for formato, mimetype in FORMATOS_DERIVADOS.items():
+            salida = BytesIO()
+            copia.save(salida, format=formato.upper(), quality=80)
+            formatos[formato] = str(fs.put(
+                salida.getvalue(),
+                filename=f"{nombre_base}_{ancho}.{formato}",
+                content_type=mimetype
+            ))
+        variantes[str(ancho)] = formatos
+    return variantes
+
+def guardar_imagen(datos, filename, content_type, file_id=None):
+    """Guarda una imagen original en GridFS junto con sus derivados.
+    Acepta bytes o un archivo abierto. Devuelve (file_id, variantes)."""
+    if hasattr(datos, "read"):
+        datos = datos.read()
+    variantes = generar_derivados(datos, filename.rsplit(".", 1)[0])
+    extra = {"metadata": {"variantes": variantes}} if variantes else {}
+    if file_id is not None:
+        extra["_id"] = file_id
+    file_id = fs.put(datos, filename=filename, content_type=content_type, **extra)
+    return file_id, variantes
+
+def elegir_variante(archivo):
+    """Si la petición trae ?w=, devuelve el derivado más pequeño que cubra ese
+    ancho, en WebP si el navegador lo acepta y en JPEG si no."""
+    ancho = request.args.get("w", type=int)
+    variantes = (archivo.metadata or {}).get("variantes")
+    if not ancho or not variantes:
+        return archivo
+    disponibles = sorted(int(a) for a in variantes)
+    elegido = next((a for a in disponibles if a >= ancho), None)
+    if elegido is None:
+        return archivo  # el original es la versión más grande
+    formato = "webp" if request.accept_mimetypes["image/webp"] else "jpeg"
+    try:
+        variante = obtener_archivo(variantes[str(elegido)][formato])
+    except NoFile:
+        return archivo
+    archivo.close()
+    return variante
+
+# ---------------------------------------------------------------------------
+# Ingesta asíncrona de archivos (la escritura a GridFS sale del request)
+# ---------------------------------------------------------------------------
+# Escrituras simultáneas a GridFS por proceso
+INGESTA_WORKERS = int(os.getenv("INGESTA_WORKERS", 4))
+# Subidas en cola + en curso antes de frenar a los requests nuevos
+INGESTA_MAX_PENDIENTES = int(os.getenv("INGESTA_MAX_PENDIENTES", 32))
+# Segundos que un request espera por un cupo antes de responder 503
+INGESTA_ESPERA = float(os.getenv("INGESTA_ESPERA", 10))
+
+_pool_ingesta = ThreadPoolExecutor(max_workers=INGESTA_WORKERS, thread_name_prefix="ingesta")
+_cupo_ingesta = threading.BoundedSemaphore(INGESTA_MAX_PENDIENTES)
+
+
+class ColaIngestaLlena(Exception):
+    """No hay cupo en la cola de ingesta."""
+
+
+@app.errorhandler(ColaIngestaLlena)
+def cola_ingesta_llena(e):
+    if request.is_json or request.headers.get("X-Requested-With") == "XMLHttpRequest":
+        return jsonify(success=False, message="Servidor ocupado, intenta de nuevo"), 503
+    return "Servidor ocupado, intenta de nuevo en unos segundos", 503
+
+
+def _ingerir(ruta, file_id, filename, content_type, imagen, alias):
+    """Trabajo del pool: copia el temporal a GridFS y genera derivados."""
+    try:
+        with open(ruta, "rb") as origen:
+            if imagen:
+                guardar_imagen(origen, filename, content_type, file_id=file_id)
+            else:
+                fs.put(origen, _id=file_id, filename=filename, content_type=content_type)
+        estado = "listo"
+    except Exception as e:
+        print(f"Error en la ingesta de {file_id}: {e}")
+        estado = "error"
+    finally:
+        _cupo_ingesta.release()
+        try:
+            os.remove(ruta)
+        except OSError:
+            pass
+    # si el barrido de ingestas vencidas ya la dio por perdida, se queda en error
+    # (él ya la descartó)
+    ingesta = ingestas_col.find_one_and_update({"_id": file_id, "estado": "pendiente"},
+                                               {"$set": {"estado": estado, "fecha_fin": datetime.utcnow()}})
+    if ingesta is None:
+        return
+    if estado == "error":
+        # otras subidas pudieron deduplicarse sobre este id: se descarta para todas
+        descartar_ingesta(ingesta)
+    elif alias:
+        socketio.emit("media_estado", {"media_id": str(file_id), "estado": estado}, to=sala_usuario(alias))
+
+
+def _reservar_contenido(digest):
+    """Suma una referencia al contenido con ese hash. Devuelve (file_id, es_nuevo):
+    si el contenido ya existía se reutiliza su archivo de GridFS."""
+    nuevo = str(ObjectId())
+    ref = media_refs_col.find_one_and_update(
+        {"_id": digest},
+        {"$inc": {"refs": 1}, "$set": {"ultima": datetime.utcnow()},
+         "$setOnInsert": {"file_id": nuevo, "fecha": datetime.now()}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return ObjectId(ref["file_id"]), ref["file_id"] == nuevo
+
+
+def liberar_archivos(file_ids):
+    """Quita una referencia a cada archivo y borra en lote los que llegan a cero.
+    Devuelve los bytes liberados en GridFS."""
+    conteo = Counter(str(f) for f in file_ids if f)
+    if not conteo:
+        return 0
+    media_refs_col.bulk_write(
+        [UpdateOne({"file_id": f}, {"$inc": {"refs": -n}, "$set": {"ultima": datetime.utcnow()}})
+         for f, n in conteo.items()],
+        ordered=False
+    )
+    refs = list(media_refs_col.find({"file_id": {"$in": list(conteo)}}, {"file_id": 1, "refs": 1}))
+    # Archivos anteriores a la deduplicación: tienen un único dueño
+    borrar = set(conteo) - {r["file_id"] for r in refs}
+    en_cero = [r for r in refs if r["refs"] <= 0]
+    if en_cero:
+        # Si otra subida lo reutilizó entre tanto, refs ya no es <= 0 y no se borra
+        hashes = [r["_id"] for r in en_cero]
+        media_refs_col.delete_many({"_id": {"$in": hashes}, "refs": {"$lte": 0}})
+        siguen = {r["file_id"] for r in media_refs_col.find({"_id": {"$in": hashes}}, {"file_id": 1})}
+        borrar |= {r["file_id"] for r in en_cero} - siguen
+    return eliminar_archivos(borrar)
+
+
+def liberar_archivo(file_id):
+    """Quita una referencia al archivo y lo borra de GridFS cuando llega a cero."""
+    liberar_archivos([file_id])
+
+
+def encolar_media(origen, filename, content_type, imagen=False):
+    """Guarda la subida en un temporal (calculando su SHA-256 al vuelo) y agenda
+    su escritura a GridFS. Si el contenido ya existe, devuelve el id existente.
+    Devuelve de inmediato el ObjectId del archivo."""
+    if not _cupo_ingesta.acquire(timeout=INGESTA_ESPERA):
+        raise ColaIngestaLlena("servidor ocupado, intenta de nuevo")
+    tmp = None
+    try:
+        sha = hashlib.sha256()
+        if hasattr(origen, "stream"):
+            lector = origen.stream
+        elif hasattr(origen, "read"):
+            lector = origen
+        else:
+            lector = BytesIO(origen)
+        with tempfile.NamedTemporaryFile(prefix="hotquiz_", suffix=".upload", delete=False) as tmp:
+            for bloque in iter(lambda: lector.read(MEDIA_BLOQUE), b""):
+                sha.update(bloque)
+                tmp.write(bloque)
+
+        file_id, es_nuevo = _reservar_contenido(sha.hexdigest())
+        if not es_nuevo:
+            os.remove(tmp.name)
+            _cupo_ingesta.release()
+            return file_id
+
+        alias = session.get("alias")
+        ingestas_col.insert_one({
+            "_id": file_id,
+            "alias": alias,
+            "filename": filename,
+            "estado": "pendiente",
+            "fecha": datetime.utcnow()
+        })
+        _pool_ingesta.submit(_ingerir, tmp.name, file_id, filename, content_type, imagen, alias)
+    except Exception:
+        _cupo_ingesta.release()
+        if tmp is not None and os.path.exists(tmp.name):
+            os.remove(tmp.name)
+        raise
+    return file_id
+
+
+# ---------------------------------------------------------------------------
+# Subida binaria en streaming (reemplaza las imágenes en base64 dentro de JSON)
+# ---------------------------------------------------------------------------
+# tipo -> (prefijo MIME aceptado, tamaño máximo en bytes)
+LIMITES_SUBIDA = {
+    "imagen": ("image/", int(os.getenv("SUBIDA_MAX_IMAGEN", 10 * 1024 * 1024))),
+    "audio": ("audio/", int(os.getenv("SUBIDA_MAX_AUDIO", 20 * 1024 * 1024))),
+    "video": ("video/", int(os.getenv("SUBIDA_MAX_VIDEO", 200 * 1024 * 1024))),
+}
+
+
+class LectorLimitado:
+    """Envuelve un stream y aborta con 413 al pasar el límite de bytes."""
+
+    def __init__(self, origen, limite):
+        self._origen = origen
+        self.limite = limite
+        self.leidos = 0
+
+    def read(self, size=-1):
+        bloque = self._origen.read(size)
+        self.leidos += len(bloque)
+        if self.leidos > self.limite:
+            raise RequestEntityTooLarge()
+        return bloque
+
+
+@app.route("/subir/<tipo>", methods=["POST"])
+def subir_media(tipo):
+    """Recibe un archivo como cuerpo binario (Content-Type del archivo) o como
+    multipart en el campo 'archivo' y lo encola por bloques, sin base64.
+    Devuelve un subida_id para usar en la ruta que publica el contenido."""
+    alias = session.get("alias")
+    if not alias:
+        return jsonify(success=False, message="Debes iniciar sesión"), 401
+    if tipo not in LIMITES_SUBIDA:
+        return jsonify(success=False, message="Tipo de archivo no válido"), 404
+
+    prefijo, limite = LIMITES_SUBIDA[tipo]
+    if request.content_length and request.content_length > limite:
+        return jsonify(success=False, message="El archivo es demasiado grande"), 413
+
+    if request.mimetype == "multipart/form-data":
+        archivo = request.files.get("archivo")
+        if not archivo or archivo.filename == "":
+            return jsonify(success=False, message="No se envió archivo"), 400
+        origen, nombre, mimetype = archivo.stream, archivo.filename, archivo.mimetype
+    else:
+        # el cliente manda X-Filename con encodeURIComponent: los headers solo llevan Latin-1
+        nombre = unquote(request.headers.get("X-Filename", "")) or tipo
+        origen, mimetype = request.stream, request.mimetype
+
+    subtipo = mimetype.split("/", 1)[-1]
+    if not mimetype.startswith(prefijo) or (tipo == "imagen" and subtipo not in ALLOWED_IMAGE):
+        return jsonify(success=False, message="Formato de archivo no permitido"), 415
+
+    try:
+        file_id = encolar_media(
+            LectorLimitado(origen, limite),
+            secure_filename(f"{uuid4().hex}_{nombre}"),
+            mimetype,
+            imagen=(tipo == "imagen")
+        )
+    except RequestEntityTooLarge:
+        return jsonify(success=False, message="El archivo es demasiado grande"), 413
+
+    subida = subidas_col.insert_one({
+        "alias": alias,
+        "tipo": tipo,
+        "file_id": str(file_id),
+        "usada": False,
+        "fecha": datetime.utcnow()
+    })
+    return jsonify(success=True, subida_id=str(subida.inserted_id), media_id=str(file_id))
+
+
+def consumir_subida(subida_id, alias, tipo):
+    """Marca como usada una subida propia y devuelve su file_id (o None)."""
+    if not subida_id or not is_valid_objectid(subida_id):
+        return None
+    subida = subidas_col.find_one_and_update(
+        {"_id": ObjectId(subida_id), "alias": alias, "tipo": tipo, "usada": False},
+        {"$set": {"usada": True, "fecha_uso": datetime.now()}}
+    )
+    return subida["file_id"] if subida else None
+
+
+def media_desde_data_url(imagen_data, filename_base):
+    """Compatibilidad con clientes viejos que mandan la imagen como data URL."""
+    header, b64 = imagen_data.split(",", 1)
+    ext = header.split("/")[1].split(";")[0].lower()
+    if ext not in ALLOWED_IMAGE:
+        return None
+    return str(encolar_media(base64.b64decode(b64), f"{filename_base}.{ext}", f"image/{ext}", imagen=True))
+
+@app.route("/media/estado/<file_id>")
+def media_estado(file_id):
+    """Estado de una subida: pendiente, listo o error."""
+    if not is_valid_objectid(file_id):
+        return jsonify(media_id=file_id, estado="desconocido"), 404
+    ingesta = ingestas_col.find_one({"_id": ObjectId(file_id)}, {"estado": 1})
+    if ingesta:
+        return jsonify(media_id=file_id, estado=ingesta["estado"])
+    if db.fs.files.count_documents({"_id": ObjectId(file_id)}, limit=1):
+        return jsonify(media_id=file_id, estado="listo")
+    return jsonify(media_id=file_id, estado="desconocido"), 404
+
 # ¡NUEVO! Ruta para servir archivos desde GridFS
 @app.route("/media/<file_id>")
 def media(file_id):
     try:
-        file_obj = fs.get(ObjectId(file_id))
-        return send_file(
-            file_obj,
-            download_name=file_obj.filename,
-            mimetype=file_obj.content_type
-        )
+        file_obj = elegir_variante(obtener_archivo(file_id))
     except Exception as e:
         print(f"Error al servir el archivo: {e}")
         return "Archivo no encontrado", 404
+    return responder_gridfs(file_obj, download_name=file_obj.filename)
     
+# ---------------------------------------------------------------------------
+# Recolector de archivos huérfanos de GridFS
+# ---------------------------------------------------------------------------
+# colección -> (filtro, campos que guardan ids de GridFS)
+REFERENCIAS_MEDIA = {
+    "fotos_hot": ({}, ("player_image", "rival_image")),
+    "audios_hot": ({}, ("audio",)),
+    "hotreels": ({}, ("archivo_id",)),
+    "confesiones": ({}, ("imagen", "audio")),
+    "publicaciones": ({}, ("imagen_cumplimiento",)),
+    "mensajes": ({"tipo": {"$in": ["image", "audio"]}}, ("message",)),
+    "cubetas_chat": ({}, ("archivos",)),
+    "usuarios": ({}, ("avatar", "ine_frontal_id", "ine_trasera_id", "selfie_ine_id")),
+    "compras": ({}, ("comprobante_id",)),
+}
+
+def contar_referencias():
+    """Cuántas veces se usa cada id de GridFS: en las colecciones de REFERENCIAS_MEDIA
+    y en subidas sin usar. Es el valor real de media_refs.refs."""
+    conteo = Counter()
+    # las subidas van primero: una que se consume mientras tanto se cuenta de más
+    # (subida y publicación), nunca de menos
+    for sub in subidas_col.find({"usada": False}, {"file_id": 1}):
+        conteo[sub["file_id"]] += 1
+    for nombre, (filtro, campos) in REFERENCIAS_MEDIA.items():
+        for doc in db[nombre].find(filtro, {c: 1 for c in campos}):
+            for campo in campos:
+                valores = doc.get(campo)
+                for valor in valores if isinstance(valores, list) else [valores]:
+                    if valor and is_valid_objectid(valor):
+                        conteo[str(valor)] += 1
+    return conteo
+
+def referenciados_ahora(file_ids):
+    """De `file_ids`, los que hoy referencia algo. Es contar_referencias() acotado a
+    un lote, para volver a mirar justo antes de borrar."""
+    file_ids = [str(f) for f in file_ids]
+    if not file_ids:
+        return set()
+    valores = file_ids + [ObjectId(f) for f in file_ids]
+    vivos = set()
+    for nombre, (filtro, campos) in REFERENCIAS_MEDIA.items():
+        for campo in campos:
+            for doc in db[nombre].find({**filtro, campo: {"$in": valores}}, {campo: 1}):
+                encontrados = doc.get(campo)
+                vivos.update(str(v) for v in (encontrados if isinstance(encontrados, list) else [encontrados]))
+    vivos.update(str(i["_id"]) for i in ingestas_col.find(
+        {"_id": {"$in": [ObjectId(f) for f in file_ids]}, "estado": "pendiente"}, {"_id": 1}))
+    vivos.update(s["file_id"] for s in subidas_col.find({"file_id": {"$in": file_ids}, "usada": False}, {"file_id": 1}))
+    return vivos & set(file_ids)
+
+def recolectar_huerfanos(dry_run=False, lote=500, pausa=0.0, gracia=timedelta(hours=1)):
+    """Borra los archivos de fs.files que ninguna colección referencia y corrige
+    media_refs.refs con el conteo real (una referencia que no se soltó no retiene el
+    archivo para siempre). Los archivos y hashes tocados hace menos de `gracia` se
+    respetan (pueden estar subiéndose). `lote` y `pausa` limitan el ritmo de borrado.
+    Devuelve un reporte."""
+    conteo = contar_referencias()
+    vivos = set(conteo)
+    # Subidas todavía en curso
+    vivos.update(str(i["_id"]) for i in ingestas_col.find({"estado": "pendiente"}, {"_id": 1}))
+    limite = datetime.utcnow() - gracia
+    corregidos = 0
+    for ref in media_refs_col.find({}, {"file_id": 1, "refs": 1, "ultima": 1}):
+        if ref.get("ultima") and ref["ultima"] >= limite:
+            # una subida deduplicada recién sumada todavía no aparece en ninguna colección
+            vivos.add(ref["file_id"])
+            continue
+        real = conteo.get(ref["file_id"], 0)
+        if ref.get("refs") == real:
+            continue
+        corregidos += 1
+        if not dry_run:
+            # solo si nadie la tocó desde que se leyó
+            media_refs_col.update_one({"_id": ref["_id"], "refs": ref.get("refs"), "ultima": ref.get("ultima")},
+                                      {"$set": {"refs": real}})
+    archivos, padres = {}, {}
+    for f in db.fs.files.find({}, {"uploadDate": 1, "length": 1, "metadata.variantes": 1}):
+        archivos[str(f["_id"])] = f
+        for formatos in ((f.get("metadata") or {}).get("variantes") or {}).values():
+            for variante in formatos.values():
+                padres[variante] = str(f["_id"])
+            if str(f["_id"]) in vivos:
+                vivos.update(formatos.values())
+
+    huerfanos = [
+        fid for fid, f in archivos.items()
+        if fid not in vivos and f.get("uploadDate") and f["uploadDate"].replace(tzinfo=None) < limite
+    ]
+    reporte = {
+        "archivos": len(archivos),
+        "vivos": len(vivos),
+        "huerfanos": len(huerfanos),
+        "bytes": sum(archivos[fid].get("length", 0) for fid in huerfanos),
+        "refs_corregidas": corregidos,
+        "borrados": 0,
+        "dry_run": dry_run,
+    }
+    if dry_run:
+        return reporte
+
+    for i in range(0, len(huerfanos), lote):
+        grupo = huerfanos[i:i + lote]
+        # La foto de arriba puede ser vieja: una subida deduplicada o una publicación
+        # nueva pudo volver a usar el archivo (o el original de una variante).
+        revivieron = referenciados_ahora(set(grupo) | {padres[f] for f in grupo if f in padres})
+        grupo = [f for f in grupo if f not in revivieron and padres.get(f) not in revivieron]
+        # Se suelta primero el hash: una subida posterior crea uno nuevo en vez de
+        # reutilizar este archivo. Si alguna lo tomó justo antes (refs > 0 otra vez),
+        # su fila sigue y se respeta.
+        media_refs_col.delete_many({"file_id": {"$in": grupo}, "refs": {"$lte": 0}})
+        tomados = {r["file_id"] for r in media_refs_col.find({"file_id": {"$in": grupo}}, {"file_id": 1})}
+        grupo = [f for f in grupo if f not in tomados]
+        if not grupo:
+            continue
+        ids = [ObjectId(fid) for fid in grupo]
+        db.fs.files.delete_many({"_id": {"$in": ids}})
+        db.fs.chunks.delete_many({"files_id": {"$in": ids}})
+        for fid in grupo:
+            cache_media.invalidar(fid)
+        reporte["borrados"] += len(grupo)
+        if pausa and i + lote < len(huerfanos):
+            time.sleep(pausa)
+    return reporte
+
+@app.cli.command("gc-media")
+@click.option("--dry-run", is_flag=True, help="Solo reporta, no borra nada.")
+@click.option("--lote", default=500, show_default=True, help="Archivos por delete_many.")
+@click.option("--pausa", default=0.0, show_default=True, help="Segundos de espera entre lotes.")
+@click.option("--gracia-horas", default=1.0, show_default=True, help="No tocar archivos más nuevos que esto.")
+def gc_media_command(dry_run, lote, pausa, gracia_horas):
+    """Borra de GridFS los archivos que ya no referencia ninguna colección y recuenta media_refs."""
+    reporte = recolectar_huerfanos(dry_run=dry_run, lote=lote, pausa=pausa,
+                                   gracia=timedelta(hours=gracia_horas))
+    click.echo(reporte)
+
+# Ingestas que siguen "pendiente" pasado este tiempo murieron con su proceso
+INGESTA_VENCIDA = timedelta(minutes=int(os.getenv("INGESTA_VENCIDA_MINUTOS", 60)))
+# Campos de REFERENCIAS_MEDIA que son listas de ids (se limpian con $pull)
+CAMPOS_MEDIA_LISTA = {("cubetas_chat", "archivos")}
+
+def descartar_ingesta(ingesta):
+    """Deshace una ingesta que ya quedó en error: suelta su contenido deduplicado y quita
+    el id de las publicaciones que lo usan (si no, servirían 404 para siempre, y cada
+    subida con el mismo SHA-256 reutilizaría un archivo que nunca se escribió)."""
+    file_id = str(ingesta["_id"])
+    valores = [file_id, ingesta["_id"]]
+    for nombre, (filtro, campos) in REFERENCIAS_MEDIA.items():
+        for campo in campos:
+            if (nombre, campo) in CAMPOS_MEDIA_LISTA:
+                db[nombre].update_many({campo: {"$in": valores}}, {"$pull": {campo: {"$in": valores}}})
+            else:
+                db[nombre].update_many({campo: {"$in": valores}}, {"$set": {campo: None}})
+    subidas_col.update_many({"file_id": file_id, "usada": False}, {"$set": {"usada": True}})
+    # todas las referencias apuntan a un contenido que nunca se escribió: fuera el hash
+    media_refs_col.delete_many({"file_id": file_id})
+    eliminar_archivos([file_id])  # chunks sueltos de una escritura a medias
+    if ingesta.get("alias"):
+        socketio.emit("media_estado", {"media_id": file_id, "estado": "error"}, to=sala_usuario(ingesta["alias"]))
+
+def barrer_ingestas_vencidas(vencida=INGESTA_VENCIDA):
+    """Marca como error las ingestas pendientes desde hace más de `vencida` y las
+    descarta (descartar_ingesta). Devuelve cuántas ingestas se cerraron."""
+    limite = datetime.utcnow() - vencida
+    cerradas = 0
+    while True:
+        ingesta = ingestas_col.find_one_and_update(
+            {"estado": "pendiente", "fecha": {"$lt": limite}},
+            {"$set": {"estado": "error", "fecha_fin": datetime.utcnow(), "vencida": True}}
+        )
+        if ingesta is None:
+            break
+        descartar_ingesta(ingesta)
+        cerradas += 1
+    if cerradas:
+        print(f"Ingestas vencidas cerradas: {cerradas}")
+    return cerradas
+
+def barrer_subidas_vencidas(politica, dry_run=False):
+    """Borra las subidas vencidas. Las que nadie usó todavía retienen la referencia que
+    sumó encolar_media: se reclaman (consumir_subida ya no puede tomarlas) y se suelta."""
+    filtro = _filtro_vencidos(politica)
+    reporte = {"documentos": 0, "bytes": 0}
+    if dry_run:
+        reporte["documentos"] = subidas_col.count_documents(filtro)
+        return reporte
+    barrido = str(ObjectId())
+    while True:
+        ids = [d["_id"] for d in subidas_col.find({**filtro, "usada": False}, {"_id": 1}).limit(RETENCION_LOTE)]
+        if not ids:
+            break
+        subidas_col.update_many({"_id": {"$in": ids}, "usada": False}, {"$set": {"usada": "vencida", "barrido": barrido}})
+        reclamadas = list(subidas_col.find({"_id": {"$in": ids}, "barrido": barrido}, {"file_id": 1}))
+        reporte["bytes"] += liberar_archivos([d["file_id"] for d in reclamadas])
+        subidas_col.delete_many({"_id": {"$in": [d["_id"] for d in reclamadas]}})
+        reporte["documentos"] += len(reclamadas)
+    # las usadas ya pasaron su referencia a la publicación
+    reporte["documentos"] += subidas_col.delete_many({**filtro, "usada": {"$ne": False}}).deleted_count
+    return reporte
+
+@app.cli.command("ingestas-vencidas")
+@click.option("--minutos", default=INGESTA_VENCIDA.total_seconds() / 60, show_default=True,
+              help="Antigüedad a partir de la cual una ingesta pendiente se da por perdida.")
+def ingestas_vencidas_command(minutos):
+    """Cierra las ingestas que quedaron pendientes al morir su proceso."""
+    click.echo(f"Ingestas cerradas: {barrer_ingestas_vencidas(timedelta(minutes=minutos))}")
+
+# ---------------------------------------------------------------------------
+# Retención de contenido (índices TTL + barrido programado)
+# ---------------------------------------------------------------------------
+# tipo -> política. Sin "archivos" se usa un índice TTL sobre "campo_fecha";
+# con archivos de GridFS el barrido borra documentos y libera sus archivos, y con
+# "barrido" lo hace esa función.
+# campo_fecha "_id" usa la fecha embebida en el ObjectId. Todas las fechas que se
+# comparan aquí (y los TTL de Mongo) son UTC: se escriben con datetime.utcnow().
+RETENCION = {
+    "duelos": {
+        "coleccion": "fotos_hot",
+        "campo_fecha": "fecha",
+        "dias": int(os.getenv("RETENCION_DUELOS_DIAS", 7)),
+        "archivos": ("player_image", "rival_image"),
+    },
+    "publicaciones": {
+        "coleccion": "publicaciones",
+        "campo_fecha": "fecha",
+        "dias": int(os.getenv("RETENCION_PUBLICACIONES_DIAS", 30)),
+        "archivos": ("imagen_cumplimiento",),
+    },
+    "mensajes": {
+        # una cubeta del chat vence cuando vence su último mensaje
+        "coleccion": "cubetas_chat",
+        "campo_fecha": "hasta",
+        "dias": int(os.getenv("RETENCION_MENSAJES_DIAS", 180)),
+        "archivos": ("archivos",),
+    },
+    "ingestas": {
+        "coleccion": "ingestas",
+        "campo_fecha": "fecha",
+        "dias": 7,
+    },
+    "subidas": {
+        # una subida sin usar retiene su archivo: no puede vencer por TTL
+        "coleccion": "subidas",
+        "campo_fecha": "fecha",
+        "dias": 2,
+        "barrido": barrer_subidas_vencidas,
+    },
+    "notificaciones": {
+        "coleccion": "notificaciones",
+        "campo_fecha": "fecha",
+        "dias": int(os.getenv("RETENCION_NOTIFICACIONES_DIAS", 30)),
+    },
+}
+# TTL que ya no deben existir: (colección, campo). Las reacciones de audio no vencen
+# porque su índice único es lo que impide reaccionar dos veces; se borran con su audio.
+# Las subidas las borra su barrido.
+TTL_RETIRADOS = [("reacciones", "fecha"), ("subidas", "fecha")]
+# Segundos entre barridos automáticos
+RETENCION_INTERVALO = int(os.getenv("RETENCION_INTERVALO", 3600))
+RETENCION_LOTE = 500
+
+def aplicar_indices_ttl():
+    """Crea (o ajusta) los índices TTL de las políticas sin archivos adjuntos."""
+    for politica in RETENCION.values():
+        if politica.get("archivos") or politica.get("barrido") or politica["campo_fecha"] == "_id":
+            continue
+        segundos = politica["dias"] * 24 * 3600
+        campo = politica["campo_fecha"]
+        try:
+            db[politica["coleccion"]].create_index(campo, expireAfterSeconds=segundos)
+        except OperationFailure:
+            # Ya existe un índice con otro TTL: se actualiza en su lugar
+            db.command("collMod", politica["coleccion"],
+                       index={"keyPattern": {campo: 1}, "expireAfterSeconds": segundos})
+    for coleccion, campo in TTL_RETIRADOS:
+        for indice in list(db[coleccion].list_indexes()):
+            if indice.get("expireAfterSeconds") is not None and list(indice["key"]) == [campo]:
+                db[coleccion].drop_index(indice["name"])
+
+def _filtro_vencidos(politica, ahora=None):
+    limite = (ahora or datetime.utcnow()) - timedelta(days=politica["dias"])
+    if politica["campo_fecha"] == "_id":
+        return {"_id": {"$lt": ObjectId.from_datetime(limite)}}
+    return {politica["campo_fecha"]: {"$lt": limite}}
+
+def aplicar_retencion(tipo, dry_run=False):
+    """Borra los documentos vencidos de un tipo y libera sus archivos de GridFS.
+    Devuelve {"documentos": n, "bytes": liberados}."""
+    politica = RETENCION[tipo]
+    if politica.get("barrido"):
+        return politica["barrido"](politica, dry_run=dry_run)
+    col = db[politica["coleccion"]]
+    filtro = _filtro_vencidos(politica)
+    campos = politica.get("archivos", ())
+    reporte = {"documentos": 0, "bytes": 0}
+
+    if dry_run:
+        reporte["documentos"] = col.count_documents(filtro)
+        return reporte
+
+    while True:
+        ids = [d["_id"] for d in col.find(filtro, {"_id": 1}).limit(RETENCION_LOTE)]
+        if not ids:
+            break
+        archivos = []
+        if campos:
+            con_archivos = {"_id": {"$in": ids}, **politica.get("filtro_archivos", {})}
+            for doc in col.find(con_archivos, {c: 1 for c in campos}):
+                for c in campos:
+                    valores = doc.get(c)
+                    archivos.extend(v for v in (valores if isinstance(valores, list) else [valores])
+                                    if v and is_valid_objectid(v))
+        col.delete_many({"_id": {"$in": ids}})
+        borrar_listas(politica["coleccion"], ids)
+        reporte["documentos"] += len(ids)
+        if archivos:
+            reporte["bytes"] += liberar_archivos(archivos)
+    return reporte
+
+def barrer_retencion(dry_run=False):
+    """Aplica todas las políticas; las que tienen TTL las resuelve Mongo solo."""
+    reporte = {}
+    for tipo, politica in RETENCION.items():
+        if not politica.get("archivos") and not politica.get("barrido"):
+            continue
+        try:
+            reporte[tipo] = aplicar_retencion(tipo, dry_run=dry_run)
+        except Exception as e:
+            print(f"Error aplicando la retención de {tipo}: {e}")
+            reporte[tipo] = {"error": str(e)}
+    if not dry_run:
+        try:
+            reporte["ingestas_vencidas"] = barrer_ingestas_vencidas()
+        except Exception as e:
+            print(f"Error cerrando ingestas vencidas: {e}")
+        try:
+            reporte["pagos_retos"] = pagar_retos_pendientes()
+        except Exception as e:
+            print(f"Error reintentando pagos de retos: {e}")
+    print(f"Retención aplicada: {reporte}")
+    return reporte
+
+def _tomar_turno(nombre, intervalo):
+    """Solo un proceso (de todos los workers) corre la tarea en cada intervalo."""
+    ahora = datetime.utcnow()
+    try:
+        db.tareas.find_one_and_update(
+            {"_id": nombre, "proxima": {"$lte": ahora}},
+            {"$set": {"proxima": ahora + timedelta(seconds=intervalo), "ultima": ahora}},
+            upsert=True
+        )
+        return True
+    except DuplicateKeyError:
+        return False
+
+def _programador_retencion():
+    while True:
+        try:
+            if _tomar_turno("retencion", RETENCION_INTERVALO):
+                barrer_retencion()
+        except Exception as e:
+            print(f"Error en el barrido de retención: {e}")
+        time.sleep(RETENCION_INTERVALO)
+
+# Las tareas periódicas corren en su propio proceso (flask programador); los workers
+# web y los comandos de la CLI no las arrancan salvo que se pida con la variable.
+if os.getenv("RETENCION_AUTOMATICA", "0") == "1":
+    threading.Thread(target=_programador_retencion, name="retencion", daemon=True).start()
+
+@app.cli.command("retencion")
+@click.option("--tipo", type=click.Choice(sorted(RETENCION)), default=None, help="Solo este tipo de contenido.")
+@click.option("--dry-run", is_flag=True, help="Solo cuenta lo que se borraría.")
+def retencion_command(tipo, dry_run):
+    """Aplica las políticas de retención y crea los índices TTL."""
+    if not dry_run:
+        aplicar_indices_ttl()
+    if tipo:
+        click.echo({tipo: aplicar_retencion(tipo, dry_run=dry_run)})
+    else:
+        click.echo(barrer_retencion(dry_run=dry_run))
+
+# ---------------------------------------------------------------------------
+# Registro de índices de MongoDB
+# ---------------------------------------------------------------------------
+# colección -> índices. Los TTL salen de RETENCION (aplicar_indices_ttl).
+INDICES = {
+    "usuarios": [
+        IndexModel([("alias", ASCENDING)], unique=True),
+    ],
+    "mensajes": [IndexModel([("sala", ASCENDING)])],
+    "cubetas_chat": [
+        IndexModel([("sala", ASCENDING), ("n", DESCENDING)], unique=True),
+        IndexModel([("hasta", ASCENDING)]),
+    ],
+    "confesiones": [
+        IndexModel([("fecha", DESCENDING), ("_id", DESCENDING)]),
+        IndexModel([("reacciones.🔥", DESCENDING)]),
+        IndexModel([("usuario", ASCENDING)]),
+    ],
+    "comentarios": [
+        IndexModel([("audio_id", ASCENDING), ("_id", DESCENDING)]),
+    ],
+    "reacciones": [
+        IndexModel([("audio_id", ASCENDING), ("usuario", ASCENDING), ("tipo", ASCENDING)], unique=True),
+    ],
+    "retos": [
+        IndexModel([("player", ASCENDING), ("fecha", DESCENDING)]),
+        IndexModel([("retado", ASCENDING), ("fecha", DESCENDING)]),
+        IndexModel([("estado", ASCENDING), ("modo", ASCENDING), ("fecha", DESCENDING)]),
+    ],
+    "fotos_hot": [
+        IndexModel([("estado", ASCENDING), ("fecha", DESCENDING), ("_id", DESCENDING)]),
+        IndexModel([("fecha", DESCENDING)]),
+        IndexModel([("player", ASCENDING), ("rival", ASCENDING), ("estado", ASCENDING)]),
+    ],
+    "audios_hot": [IndexModel([("fecha", DESCENDING)])],
+    "hotreels": [IndexModel([("fecha", DESCENDING), ("_id", DESCENDING)])],
+    "publicaciones": [IndexModel([("fecha", DESCENDING), ("_id", DESCENDING)])],
+    "adivina": [IndexModel([("fecha", DESCENDING)])],
+    "donaciones_tokens": [
+        IndexModel([("fecha", DESCENDING)]),
+        IndexModel([("para", ASCENDING)]),
+    ],
+    "media_refs": [IndexModel([("file_id", ASCENDING)], unique=True)],
+    "ingestas": [IndexModel([("estado", ASCENDING)])],
+    "subidas": [IndexModel([("usada", ASCENDING), ("fecha", ASCENDING)])],
+    "ranking": [IndexModel([("publicaciones", DESCENDING), ("_id", ASCENDING)])],
+    "cubetas": [IndexModel([("lista", ASCENDING), ("padre", ASCENDING), ("n", ASCENDING)], unique=True)],
+    "votos_retos": [IndexModel([("reto_id", ASCENDING)])],
+    "notificaciones": [
+        IndexModel([("para", ASCENDING), ("leido", ASCENDING), ("fecha", DESCENDING)]),
+        IndexModel([("para", ASCENDING), ("fecha", DESCENDING)]),
+    ],
+    "seguimientos": [
+        IndexModel([("seguidor", ASCENDING), ("seguido", ASCENDING)], unique=True),
+        IndexModel([("seguido", ASCENDING), ("seguidor", ASCENDING)]),
+    ],
+}
+
+# (ruta, colección, filtro, orden) representativos de cada camino caliente
+CONSULTAS_CANONICAS = [
+    ("get_user_and_saldo", "usuarios", {"alias": "__explain__"}, None),
+    ("chat", "cubetas_chat", {"sala": "a_b"}, [("n", -1)]),
+    ("confesiones", "confesiones", {}, [("fecha", -1), ("_id", -1)]),
+    ("confesiones_filtro", "confesiones", {}, [("reacciones.🔥", -1)]),
+    ("audio_hot", "audios_hot", {}, [("fecha", -1)]),
+    ("audio_hot_autores", "usuarios", {"alias": {"$in": ["__explain__"]}}, None),
+    ("audio_comentarios", "comentarios", {"audio_id": "__explain__"}, [("_id", -1)]),
+    ("reaccion_audio", "reacciones", {"audio_id": "__explain__", "usuario": "a", "tipo": "t"}, None),
+    ("jugar", "retos", {"estado": "pendiente"}, None),
+    ("lanzar", "retos", {"player": "__explain__"}, [("fecha", -1)]),
+    ("lanzar", "retos", {"retado": "__explain__"}, [("fecha", -1)]),
+    ("lanzar", "retos", {"modo": "publico", "estado": "pendiente"}, [("fecha", -1)]),
+    ("foto_hot", "fotos_hot", {"estado": "pendiente"}, [("fecha", -1), ("_id", -1)]),
+    ("hot_shorts", "hotreels", {}, [("fecha", -1), ("_id", -1)]),
+    ("hot_roulette", "publicaciones", {}, [("fecha", -1), ("_id", -1)]),
+    ("adivina", "adivina", {}, [("fecha", -1)]),
+    ("liberar_archivos", "media_refs", {"file_id": "__explain__"}, None),
+    ("perfiles", "ranking", {"publicaciones": {"$gt": 0}}, [("publicaciones", -1), ("_id", 1)]),
+    ("agregar_a_lista", "cubetas", {"lista": "confesiones.comentarios", "padre": "__explain__", "n": 0}, None),
+    ("notificaciones_no_leidas", "notificaciones", {"para": "__explain__", "leido": False}, [("fecha", -1)]),
+    ("perfiles_sigo", "seguimientos", {"seguidor": "__explain__", "seguido": {"$in": ["a"]}}, None),
+]
+
+def aplicar_indices():
+    """Crea los índices registrados. Es idempotente: los que ya existen no se tocan.
+    Devuelve {colección: [nombres] | "error: ..."}."""
+    resultado = {}
+    for nombre, modelos in INDICES.items():
+        try:
+            resultado[nombre] = db[nombre].create_indexes(modelos)
+        except OperationFailure as e:
+            # p. ej. duplicados que impiden un índice único: hay que limpiarlos a mano
+            resultado[nombre] = f"error: {e}"
+    aplicar_indices_ttl()
+    return resultado
+
+def _etapas_plan(plan):
+    """Lista las etapas (stage) de un plan de explain(), recursivamente."""
+    etapas = [plan.get("stage")] if plan.get("stage") else []
+    for clave in ("inputStage", "queryPlan"):
+        if isinstance(plan.get(clave), dict):
+            etapas += _etapas_plan(plan[clave])
+    for hijo in plan.get("inputStages", []):
+        etapas += _etapas_plan(hijo)
+    return etapas
+
+def reporte_explain():
+    """Corre explain() sobre cada consulta canónica y marca los COLLSCAN."""
+    filas = []
+    for ruta, nombre, filtro, orden in CONSULTAS_CANONICAS:
+        cursor = db[nombre].find(filtro).limit(20)
+        if orden:
+            cursor = cursor.sort(orden)
+        plan = cursor.explain().get("queryPlanner", {}).get("winningPlan", {})
+        etapas = _etapas_plan(plan)
+        filas.append({
+            "ruta": ruta,
+            "coleccion": nombre,
+            "etapas": etapas,
+            "collscan": "COLLSCAN" in etapas,
+        })
+    return filas
+
+def _indices_al_iniciar():
+    try:
+        aplicar_indices()
+    except Exception as e:
+        print(f"Error creando índices: {e}")
+
+if os.getenv("INDICES_AL_INICIAR", "0") == "1":
+    threading.Thread(target=_indices_al_iniciar, name="indices", daemon=True).start()
+
+@app.cli.group("indices")
+def indices_cli():
+    """Índices de MongoDB."""
+
+@indices_cli.command("aplicar")
+def indices_aplicar_command():
+    """Crea los índices registrados (idempotente)."""
+    for nombre, res in aplicar_indices().items():
+        click.echo(f"{nombre}: {res}")
+
+@indices_cli.command("explain")
+def indices_explain_command():
+    """Muestra el plan de cada consulta canónica y marca los COLLSCAN."""
+    filas = reporte_explain()
+    for fila in filas:
+        marca = "COLLSCAN ⚠" if fila["collscan"] else "ok"
+        click.echo(f"{marca:12} {fila['ruta']:20} {fila['coleccion']:15} {' > '.join(fila['etapas'])}")
+    if any(f["collscan"] for f in filas):
+        raise SystemExit(1)
+
+# ---------------------------------------------------------------------------
+# Estadísticas de autores (tokens recibidos)
+# ---------------------------------------------------------------------------
+
+class CacheTTL:
+    """Caché clave -> valor con vencimiento, compartida por los requests del proceso."""
+
+    def __init__(self, ttl, max_items=10000):
+        self.ttl = ttl
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, claves):
+        """Devuelve {clave: valor} solo con las claves presentes y vigentes."""
+        ahora = time.monotonic()
+        encontrados = {}
+        with self._lock:
+            for clave in claves:
+                item = self._items.get(clave)
+                if item is None:
+                    continue
+                valor, vence = item
+                if vence < ahora:
+                    del self._items[clave]
+                    continue
+                encontrados[clave] = valor
+        return encontrados
+
+    def set(self, clave, valor):
+        with self._lock:
+            self._items.pop(clave, None)
+            self._items[clave] = (valor, time.monotonic() + self.ttl)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def incr(self, clave, delta):
+        """Suma delta solo si la clave ya está cacheada; si no, el próximo get la lee de Mongo."""
+        with self._lock:
+            item = self._items.get(clave)
+            if item is not None:
+                self._items[clave] = (item[0] + delta, item[1])
+
+    def invalidar(self, clave):
+        with self._lock:
+            self._items.pop(clave, None)
+
+
+cache_tokens_autor = CacheTTL(ttl=int(os.getenv("TOKENS_AUTOR_TTL", 60)))
+
+def tokens_recibidos_por_autor(aliases):
+    """Tokens recibidos por cada alias pedido. Solo consulta Mongo por los que no están en caché."""
+    aliases = set(a for a in aliases if a)
+    totales = cache_tokens_autor.get_many(aliases)
+    faltan = aliases - totales.keys()
+    if faltan:
+        leidos = {
+            u["alias"]: int(u.get("tokens_recibidos", 0))
+            for u in usuarios_col.find({"alias": {"$in": list(faltan)}}, {"alias": 1, "tokens_recibidos": 1})
+        }
+        for alias in faltan:
+            totales[alias] = leidos.get(alias, 0)
+            cache_tokens_autor.set(alias, totales[alias])
+    return totales
+
+def sumar_tokens_recibidos(autor, cantidad=1, **otros_inc):
+    """Acredita tokens recibidos al autor (más otros $inc opcionales) y actualiza la caché."""
+    usuarios_col.update_one({"alias": autor}, {"$inc": {"tokens_recibidos": cantidad, **otros_inc}})
+    cache_tokens_autor.incr(autor, cantidad)
+
+def recalcular_tokens_recibidos():
+    """Reconstruye usuarios.tokens_recibidos a partir de donaciones_tokens (para datos previos al contador)."""
+    donaciones_col.aggregate([
+        {"$match": {"para": {"$ne": None}}},
+        {"$group": {"_id": "$para", "total": {"$sum": 1}}},
+        {"$project": {"_id": 0, "alias": "$_id", "tokens_recibidos": "$total"}},
+        {"$merge": {
+            "into": usuarios_col.name,
+            "on": "alias",
+            "whenMatched": [{"$set": {"tokens_recibidos": "$$new.tokens_recibidos"}}],
+            "whenNotMatched": "discard",
+        }},
+    ])
+
+@app.cli.command("tokens-recibidos")
+def tokens_recibidos_command():
+    """Recalcula el contador de tokens recibidos de cada autor."""
+    recalcular_tokens_recibidos()
+    click.echo("Contadores de tokens recibidos recalculados.")
+
 def is_valid_objectid(id_string):
     """Verifica si una cadena es un ObjectId válido."""
     try:
@@ -101,18 +1443,500 @@ def is_valid_objectid(id_string):
 # ¡IMPORTANTE! Agrega esta línea para registrar el filtro en Jinja2
 app.jinja_env.filters['is_valid_objectid'] = is_valid_objectid
 
+# ---------------------------------------------------------------------------
+# Contadores con escritura agrupada (likes, fuegos, reacciones, votos)
+# ---------------------------------------------------------------------------
+# Los clics no escriben al momento: se acumulan por (colección, _id, campo) y un hilo
+# los manda cada CONTADORES_INTERVALO segundos (o al juntar CONTADORES_MAX_CLAVES
+# documentos, o al apagar el proceso) en un bulk_write por colección. Las lecturas
+# suman lo pendiente para que cada quien vea sus propios clics.
+CONTADORES_INTERVALO = float(os.getenv("CONTADORES_INTERVALO", 1.0))
+CONTADORES_MAX_CLAVES = int(os.getenv("CONTADORES_MAX_CLAVES", 500))
+
+
+class BufferContadores:
+    """Deltas de $inc pendientes, agrupados por documento."""
+
+    def __init__(self, intervalo=CONTADORES_INTERVALO, max_claves=CONTADORES_MAX_CLAVES):
+        self.intervalo = intervalo
+        self.max_claves = max_claves
+        self._pendientes = {}
+        # lo que se está escribiendo: sigue contando en las lecturas hasta que termina
+        self._en_vuelo = {}
+        self._lock = threading.Lock()
+        self._escritura = threading.Lock()
+        self._despertar = threading.Event()
+        self._hilo = None
+
+    def sumar(self, coleccion, doc_id, campo, delta=1):
+        clave = (coleccion, ObjectId(doc_id))
+        with self._lock:
+            self._pendientes.setdefault(clave, Counter())[campo] += delta
+            lleno = len(self._pendientes) >= self.max_claves
+        self._arrancar()
+        if lleno:
+            self._despertar.set()
+
+    def pendientes(self, coleccion, doc_id):
+        """Deltas aún no escritos de un documento: {campo: delta}."""
+        clave = (coleccion, doc_id if isinstance(doc_id, ObjectId) else ObjectId(doc_id))
+        with self._lock:
+            total = Counter(self._en_vuelo.get(clave, {}))
+            total.update(self._pendientes.get(clave, {}))
+        return total
+
+    def superponer(self, coleccion, docs):
+        """Suma a `docs` (leídos de Mongo) los deltas pendientes. Devuelve docs."""
+        if not self._pendientes and not self._en_vuelo:
+            return docs
+        for doc in docs:
+            if not isinstance(doc.get("_id"), ObjectId):
+                continue
+            for campo, delta in self.pendientes(coleccion, doc["_id"]).items():
+                *ruta, hoja = campo.split(".")
+                destino = doc
+                for parte in ruta:
+                    destino = destino.setdefault(parte, {})
+                destino[hoja] = (destino.get(hoja) or 0) + delta
+        return docs
+
+    def vaciar(self):
+        """Escribe todo lo pendiente en un bulk_write por colección. Devuelve los documentos escritos."""
+        with self._escritura:
+            with self._lock:
+                lote, self._pendientes = self._pendientes, {}
+                self._en_vuelo = lote
+            if not lote:
+                return 0
+            por_coleccion = {}
+            for (coleccion, doc_id), deltas in lote.items():
+                por_coleccion.setdefault(coleccion, {})[doc_id] = deltas
+            # Solo se reintenta lo que Mongo dice que falló. Con ordered=False el resto ya
+            # quedó aplicado, y ante un error sin detalle (red, timeout, tras el reintento
+            # propio de pymongo) no se sabe qué se aplicó: esos deltas se descartan y se
+            # registran. Preferimos perder algún clic a inflar contadores.
+            reintentar = []
+            escritos = 0
+            for coleccion, docs in por_coleccion.items():
+                claves = list(docs)
+                try:
+                    db[coleccion].bulk_write(
+                        [UpdateOne({"_id": doc_id}, {"$inc": dict(docs[doc_id])}) for doc_id in claves],
+                        ordered=False
+                    )
+                    escritos += len(claves)
+                except BulkWriteError as e:
+                    fallidos = {err["index"] for err in e.details.get("writeErrors", [])}
+                    print(f"Error escribiendo contadores de {coleccion}: {len(fallidos)} operaciones fallaron")
+                    reintentar.extend((coleccion, claves[i]) for i in fallidos)
+                    escritos += len(claves) - len(fallidos)
+                except Exception as e:
+                    perdidos = sum(sum(d.values()) for d in docs.values())
+                    print(f"Error escribiendo contadores de {coleccion}, se descartan {perdidos} clics: {e}")
+            with self._lock:
+                for clave in reintentar:
+                    self._pendientes.setdefault(clave, Counter()).update(lote[clave])
+                self._en_vuelo = {}
+            return escritos
+
+    def _arrancar(self):
+        if self._hilo is None or not self._hilo.is_alive():
+            with self._lock:
+                if self._hilo is None or not self._hilo.is_alive():
+                    self._hilo = threading.Thread(target=self._bucle, name="contadores", daemon=True)
+                    self._hilo.start()
+
+    def _bucle(self):
+        while True:
+            self._despertar.wait(self.intervalo)
+            self._despertar.clear()
+            try:
+                self.vaciar()
+            except Exception as e:
+                print(f"Error vaciando contadores: {e}")
+
+
+contadores = BufferContadores()
+atexit.register(contadores.vaciar)
+
+# ---------------------------------------------------------------------------
+# Paginación por cursor (fecha, _id)
+# ---------------------------------------------------------------------------
+# Los feeds se ordenan por (fecha desc, _id desc) y cada página devuelve un cursor
+# opaco con la última posición vista: no hay skip() y lo insertado mientras tanto
+# no corre los resultados. Respuesta JSON: {"items": [...], "next_cursor": str | None}.
+ORDEN_FEED = [("fecha", DESCENDING), ("_id", DESCENDING)]
+
+class CursorInvalido(Exception):
+    """El cursor recibido no se puede decodificar."""
+
+
+@app.errorhandler(CursorInvalido)
+def cursor_invalido(e):
+    return jsonify(success=False, message="Cursor inválido"), 400
+
+
+def codificar_cursor(doc):
+    fecha = doc.get("fecha")
+    token = json.dumps({
+        "f": fecha.isoformat() if isinstance(fecha, datetime) else None,
+        "i": str(doc["_id"]),
+    })
+    return base64.urlsafe_b64encode(token.encode()).decode().rstrip("=")
+
+def decodificar_cursor(cursor):
+    try:
+        token = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        fecha = datetime.fromisoformat(token["f"]) if token["f"] else None
+        return fecha, ObjectId(token["i"])
+    except (ValueError, TypeError, KeyError, InvalidId):
+        raise CursorInvalido()
+
+def filtro_cursor(cursor=None, filtro=None):
+    """Combina `filtro` con la condición "después de `cursor`" en el orden del feed."""
+    condiciones = [filtro] if filtro else []
+    if cursor:
+        fecha, oid = decodificar_cursor(cursor)
+        if fecha is None:
+            condiciones.append({"fecha": None, "_id": {"$lt": oid}})
+        else:
+            condiciones.append({"$or": [
+                {"fecha": {"$lt": fecha}},
+                {"fecha": fecha, "_id": {"$lt": oid}},
+                {"fecha": None},
+            ]})
+    return condiciones[0] if len(condiciones) == 1 else ({"$and": condiciones} if condiciones else {})
+
+def cortar_pagina(docs, limite):
+    """Recibe hasta limite + 1 docs ya ordenados; devuelve (página, next_cursor)."""
+    siguiente = codificar_cursor(docs[limite - 1]) if len(docs) > limite else None
+    return docs[:limite], siguiente
+
+def pagina_por_cursor(col, cursor=None, limite=10, filtro=None):
+    """Una página del feed de `col` a partir de `cursor`. Devuelve (docs, next_cursor)."""
+    docs = list(col.find(filtro_cursor(cursor, filtro)).sort(ORDEN_FEED).limit(limite + 1))
+    return cortar_pagina(contadores.superponer(col.name, docs), limite)
+
+def _limite_pedido(defecto, maximo=50):
+    return max(1, min(request.args.get("limit", defecto, type=int), maximo))
+
+# ---------------------------------------------------------------------------
+# Listas en cubetas (comentarios, votantes, votos)
+# ---------------------------------------------------------------------------
+# Las listas que solo crecen no viven en el documento padre: cada elemento va a una
+# cubeta {lista, padre, n, cuenta, items} de TAM_CUBETA elementos en cubetas_col.
+# El padre guarda total_<campo> y, si la lista tiene previa, los últimos N elementos
+# en <campo> (así las plantillas siguen leyendo p. ej. conf.comentarios).
+TAM_CUBETA = int(os.getenv("TAM_CUBETA", 100))
+
+LISTAS = {
+    "confesiones.comentarios": {"coleccion": "confesiones", "campo": "comentarios", "previa": 20},
+    "hotreels.comentarios": {"coleccion": "hotreels", "campo": "comentarios", "previa": 20},
+    "fotos_hot.comentarios": {"coleccion": "fotos_hot", "campo": "comentarios", "previa": 20},
+    "adivina.comentarios": {"coleccion": "adivina", "campo": "comentarios", "previa": 20},
+    "fotos_hot.votantes": {"coleccion": "fotos_hot", "campo": "votantes", "previa": 0},
+}
+# Los votos de los retos viven solo en votos_retos (ver "Liquidación de retos"); esta
+# lista quedó de antes y migrar_votos_reto() la vacía.
+LISTA_VOTOS_RETOS = "retos.votos"
+
+def _filtro_padre(conf, padre):
+    clave = conf.get("clave", "_id")
+    return {clave: ObjectId(padre) if clave == "_id" else padre}
+
+def _guardar_en_cubeta(lista, padre, n, cambios):
+    filtro = {"lista": lista, "padre": str(padre), "n": n}
+    try:
+        cubetas_col.update_one(filtro, cambios, upsert=True)
+    except DuplicateKeyError:
+        # otro request creó la misma cubeta a la vez; ahora ya existe
+        cubetas_col.update_one(filtro, cambios)
+
+def migrar_padre(lista, doc):
+    """Pasa la lista embebida de un padre a cubetas y deja en él el total y la previa.
+    Es idempotente y puede correr a la vez en dos requests: las cubetas solo se crean
+    ($setOnInsert, así otro migrador no pisa lo que ya se agregó con $push) y el padre
+    solo se toca si no tiene total."""
+    conf = LISTAS[lista]
+    campo = conf["campo"]
+    clave = conf.get("clave", "_id")
+    items = doc.get(campo) or []
+    for n in range(0, len(items), TAM_CUBETA):
+        grupo = items[n:n + TAM_CUBETA]
+        _guardar_en_cubeta(lista, doc[clave], n // TAM_CUBETA,
+                           {"$setOnInsert": {"items": grupo, "cuenta": len(grupo)}})
+    cambios = {"$set": {f"total_{campo}": len(items)}}
+    if conf["previa"]:
+        cambios["$set"][campo] = items[-conf["previa"]:]
+    else:
+        cambios["$unset"] = {campo: ""}
+    if conf.get("al_migrar"):
+        cambios["$set"].update(conf["al_migrar"](doc, items))
+    db[conf["coleccion"]].update_one({clave: doc[clave], f"total_{campo}": {"$exists": False}}, cambios)
+
+def agregar_a_lista(lista, padre, item, inc=None, condicion=None):
+    """Agrega `item` a la lista del padre. `inc` suma otros contadores del padre en la misma
+    escritura y `condicion` se exige al padre (p. ej. un estado). Devuelve el padre
+    actualizado (total y contadores) o None si no existe o no cumple la condición."""
+    conf = LISTAS[lista]
+    col = db[conf["coleccion"]]
+    campo = conf["campo"]
+    total = f"total_{campo}"
+    filtro = {**_filtro_padre(conf, padre), **(condicion or {})}
+    cambios = {"$inc": {total: 1, **(inc or {})}}
+    if conf["previa"]:
+        cambios["$push"] = {campo: {"$each": [item], "$slice": -conf["previa"]}}
+    proyeccion = {total: 1, **{k: 1 for k in (inc or {})}}
+
+    doc = col.find_one_and_update({**filtro, total: {"$exists": True}}, cambios,
+                                  projection=proyeccion, return_document=ReturnDocument.AFTER)
+    if doc is None:
+        # padre previo a las cubetas: se migra la primera vez que se escribe en él
+        viejo = col.find_one(filtro)
+        if viejo is None:
+            return None
+        migrar_padre(lista, viejo)
+        doc = col.find_one_and_update({**filtro, total: {"$exists": True}}, cambios,
+                                      projection=proyeccion, return_document=ReturnDocument.AFTER)
+        if doc is None:
+            return None
+    _guardar_en_cubeta(lista, padre, (doc[total] - 1) // TAM_CUBETA,
+                       {"$push": {"items": item}, "$inc": {"cuenta": 1}})
+    return doc
+
+def leer_lista(lista, padre, cubeta=None):
+    """Elementos de una cubeta (por defecto la más nueva). Devuelve (items, cubeta anterior | None)."""
+    filtro = {"lista": lista, "padre": str(padre)}
+    if cubeta is not None:
+        filtro["n"] = cubeta
+    doc = cubetas_col.find_one(filtro, sort=[("n", DESCENDING)])
+    if not doc:
+        return [], None
+    return doc.get("items", []), (doc["n"] - 1 if doc["n"] > 0 else None)
+
+def leer_lista_antes(lista, padre, antes, limite=20):
+    """Hasta `limite` elementos anteriores a la posición `antes` (el elemento i vive en
+    la cubeta i // TAM_CUBETA), del más viejo al más nuevo. Devuelve (items, antes | None)."""
+    if antes <= 0:
+        return [], None
+    desde = max(0, antes - limite)
+    cubetas = cubetas_col.find(
+        {"lista": lista, "padre": str(padre), "n": {"$gte": desde // TAM_CUBETA, "$lte": (antes - 1) // TAM_CUBETA}},
+        {"n": 1, "items": 1}
+    ).sort("n", ASCENDING)
+    items = []
+    for cubeta in cubetas:
+        base = cubeta["n"] * TAM_CUBETA
+        items.extend(item for i, item in enumerate(cubeta.get("items", [])) if desde <= base + i < antes)
+    return items, (desde or None)
+
+def padres_con(lista, padres, **campos):
+    """De `padres`, los que tienen en la lista un elemento con esos campos (p. ej. usuario=alias)."""
+    return {
+        c["padre"] for c in cubetas_col.find(
+            {"lista": lista, "padre": {"$in": [str(p) for p in padres]}, "items": {"$elemMatch": campos}},
+            {"padre": 1}
+        )
+    }
+
+def en_lista(lista, padre, **campos):
+    return bool(padres_con(lista, [padre], **campos))
+
+def borrar_listas(coleccion, padres):
+    """Borra las cubetas de los padres eliminados de `coleccion`."""
+    listas = [nombre for nombre, conf in LISTAS.items() if conf["coleccion"] == coleccion]
+    if listas and padres:
+        cubetas_col.delete_many({"lista": {"$in": listas}, "padre": {"$in": [str(p) for p in padres]}})
+
+def migrar_listas(lote=500):
+    """Migra a cubetas todos los padres que aún no tienen total, los arrays de
+    followers/following a seguimientos y las notificaciones a su colección.
+    Devuelve {lista: padres migrados}."""
+    reporte = {}
+    for lista, conf in LISTAS.items():
+        col = db[conf["coleccion"]]
+        total = f"total_{conf['campo']}"
+        migrados = 0
+        while True:
+            docs = list(col.find({total: {"$exists": False}}).limit(lote))
+            if not docs:
+                break
+            for doc in docs:
+                migrar_padre(lista, doc)
+            migrados += len(docs)
+        reporte[lista] = migrados
+    reporte[LISTA_VOTOS_RETOS] = migrar_votos_retos(lote)
+    reporte["seguimientos"] = migrar_seguimientos(lote)
+    reporte["notificaciones"] = migrar_notificaciones(lote)
+    return reporte
+
+def migrar_seguimientos(lote=500):
+    """Convierte usuarios.followers/following en documentos de seguimientos."""
+    migrados = 0
+    while True:
+        docs = list(usuarios_col.find(
+            {"$or": [{"followers": {"$exists": True}}, {"following": {"$exists": True}}]},
+            {"alias": 1, "followers": 1, "following": 1}
+        ).limit(lote))
+        if not docs:
+            break
+        for doc in docs:
+            aristas = {(doc["alias"], otro) for otro in doc.get("following", [])}
+            aristas |= {(otro, doc["alias"]) for otro in doc.get("followers", [])}
+            for seguidor, seguido in aristas:
+                try:
+                    seguimientos_col.insert_one({"seguidor": seguidor, "seguido": seguido, "fecha": datetime.utcnow()})
+                except DuplicateKeyError:
+                    pass
+            usuarios_col.update_one({"_id": doc["_id"]}, {"$unset": {"followers": "", "following": ""}})
+            migrados += 1
+    return migrados
+
+@app.cli.command("migrar-listas")
+@click.option("--lote", default=500, show_default=True, help="Padres por lote.")
+def migrar_listas_command(lote):
+    """Pasa los arrays embebidos (comentarios, votos, seguidores, notificaciones) fuera de sus padres."""
+    for lista, migrados in migrar_listas(lote).items():
+        click.echo(f"{lista}: {migrados}")
+
+@app.route("/comentarios/<coleccion>/<padre_id>")
+def comentarios_anteriores(coleccion, padre_id):
+    """Comentarios guardados en cubetas. ?antes=i pide los anteriores a la posición i
+    (la previa embebida empieza en total - len(previa)); ?cubeta=n pide una cubeta entera."""
+    lista = f"{coleccion}.comentarios"
+    if lista not in LISTAS or not is_valid_objectid(padre_id):
+        return jsonify(success=False, message="Lista no encontrada"), 404
+    antes = request.args.get("antes", type=int)
+    if antes is None:
+        items, anterior = leer_lista(lista, padre_id, request.args.get("cubeta", type=int))
+        return jsonify(items=items, anterior=anterior)
+    items, antes = leer_lista_antes(lista, padre_id, antes, _limite_pedido(20))
+    return jsonify(items=[{
+        "usuario": c.get("usuario") or c.get("user") or "Anónimo",
+        "texto": c.get("texto", ""),
+        "fecha": c["fecha"].isoformat() if isinstance(c.get("fecha"), datetime) else None,
+    } for c in items], antes=antes)
+
+# ---------------------------------------------------------------------------
+# Notificaciones
+# ---------------------------------------------------------------------------
+# Una por documento: {para, tipo, mensaje, leido, fecha}. Se entregan en vivo por
+# socketio a la sala personal del alias; vencen a los RETENCION["notificaciones"] días (TTL)
+# y cada usuario conserva como mucho NOTIFICACIONES_MAX.
+NOTIFICACIONES_MAX = int(os.getenv("NOTIFICACIONES_MAX", 200))
+
+def _notificacion_json(n):
+    return {
+        "id": str(n["_id"]),
+        "tipo": n.get("tipo"),
+        "mensaje": n.get("mensaje"),
+        "leido": n.get("leido", False),
+        "fecha": n["fecha"].isoformat() if isinstance(n.get("fecha"), datetime) else None,
+    }
+
+def notificar(alias, tipo, mensaje, **datos):
+    """Guarda la notificación, la empuja por socketio y recorta las más viejas del usuario."""
+    if not alias:
+        return None
+    notificacion = {"para": alias, "tipo": tipo, "mensaje": mensaje, "leido": False,
+                    "fecha": datetime.utcnow(), **datos}
+    notificaciones_col.insert_one(notificacion)
+    try:
+        socketio.emit("notificacion", _notificacion_json(notificacion), to=sala_usuario(alias))
+    except Exception as e:
+        print(f"Error enviando la notificación a {alias}: {e}")
+    viejas = [n["_id"] for n in notificaciones_col.find({"para": alias}, {"_id": 1})
+              .sort("fecha", DESCENDING).skip(NOTIFICACIONES_MAX).limit(100)]
+    if viejas:
+        notificaciones_col.delete_many({"_id": {"$in": viejas}})
+    return notificacion
+
+def notificaciones_no_leidas(alias, limite=20):
+    return list(notificaciones_col.find({"para": alias, "leido": False})
+                .sort("fecha", DESCENDING).limit(limite))
+
+def migrar_notificaciones(lote=500):
+    """Mueve usuarios.notificaciones (embebidas o en cubetas) a la colección notificaciones."""
+    migrados = 0
+    filtro = {"$or": [{"notificaciones": {"$exists": True}}, {"total_notificaciones": {"$exists": True}}]}
+    while True:
+        docs = list(usuarios_col.find(filtro, {"alias": 1, "notificaciones": 1, "total_notificaciones": 1}).limit(lote))
+        if not docs:
+            break
+        for doc in docs:
+            if "total_notificaciones" in doc:
+                items = [n for c in cubetas_col.find({"lista": "usuarios.notificaciones", "padre": doc["alias"]}).sort("n", 1)
+                         for n in c.get("items", [])]
+            else:
+                items = doc.get("notificaciones") or []
+            if items:
+                notificaciones_col.insert_many([
+                    {"para": doc["alias"], "tipo": n.get("tipo"), "mensaje": n.get("mensaje"),
+                     "leido": n.get("leido", False), "fecha": n.get("fecha") or datetime.utcnow()}
+                    for n in items[-NOTIFICACIONES_MAX:]
+                ])
+            usuarios_col.update_one({"_id": doc["_id"]}, {"$unset": {"notificaciones": "", "total_notificaciones": ""}})
+            cubetas_col.delete_many({"lista": "usuarios.notificaciones", "padre": doc["alias"]})
+            migrados += 1
+    return migrados
+
+@app.route("/notificaciones")
+def notificaciones():
+    alias = session.get("alias")
+    if not alias:
+        return jsonify(success=False, message="Debes iniciar sesión"), 401
+    filtro = {"para": alias}
+    if request.args.get("no_leidas") == "1":
+        filtro["leido"] = False
+    limite = max(1, min(request.args.get("limit", 20, type=int), 100))
+    items = notificaciones_col.find(filtro).sort("fecha", DESCENDING).limit(limite)
+    return jsonify(items=[_notificacion_json(n) for n in items])
+
+@app.route("/notificaciones/no_leidas")
+def notificaciones_contador():
+    alias = session.get("alias")
+    if not alias:
+        return jsonify(success=False, message="Debes iniciar sesión"), 401
+    return jsonify(no_leidas=notificaciones_col.count_documents({"para": alias, "leido": False}))
+
+@app.route("/notificaciones/leer", methods=["POST"])
+def notificaciones_leer():
+    """Marca como leídas las notificaciones indicadas en {"ids": [...]}, o todas si no vienen ids."""
+    alias = session.get("alias")
+    if not alias:
+        return jsonify(success=False, message="Debes iniciar sesión"), 401
+    filtro = {"para": alias, "leido": False}
+    ids = (request.get_json(silent=True) or {}).get("ids")
+    if ids:
+        filtro["_id"] = {"$in": [ObjectId(i) for i in ids if is_valid_objectid(i)]}
+    res = notificaciones_col.update_many(filtro, {"$set": {"leido": True}})
+    return jsonify(success=True, marcadas=res.modified_count)
+
 # ---------------------------------------------------------------------------
 # Helper: obtener usuario y saldo
 # ---------------------------------------------------------------------------
 
-def get_user_and_saldo():
+# Campos del usuario en sesión que usan las rutas; el resto se pide con usuario_actual("campo")
+CAMPOS_USUARIO = {"alias", "tokens_oro", "tokens_plata", "verificado", "avatar"}
+
+def usuario_actual(*extra):
+    """Documento (proyectado) del usuario en sesión, leído a lo sumo una vez por request.
+    Los campos `extra` conviene pedirlos en la primera llamada para no releer."""
     alias = session.get("alias")
     if not alias:
+        return None
+    cargado = g.get("usuario_actual")
+    if cargado is None or cargado[0] != alias or not set(extra) <= cargado[1]:
+        campos = CAMPOS_USUARIO | set(extra) | (cargado[1] if cargado and cargado[0] == alias else set())
+        doc = usuarios_col.find_one({"alias": alias}, {c: 1 for c in campos})
+        cargado = g.usuario_actual = (alias, campos, doc)
+    return cargado[2]
+
+def get_user_and_saldo():
+    user = usuario_actual()
+    if not user:
         return None, 0, 0
-    user = usuarios_col.find_one({"alias": alias})
-    oro = int(user.get("tokens_oro", 0)) if user else 0
-    plata = int(user.get("tokens_plata", 0)) if user else 0
-    return alias, oro, plata
+    return user["alias"], int(user.get("tokens_oro", 0)), int(user.get("tokens_plata", 0))
 
 # ---------------------------------------------------------------------------
 # Rutas de autenticación
@@ -153,14 +1977,19 @@ def registro():
             return redirect(url_for("registro"))
 
         hashed_password = generate_password_hash(password)
-        usuarios_col.insert_one({
-            "alias": alias,
-            "email": email,
-            "password": hashed_password,
-            "tokens_oro": 0,
-            "tokens_plata": 100,
-            "verificado": False
-        })
+        try:
+            usuarios_col.insert_one({
+                "alias": alias,
+                "email": email,
+                "password": hashed_password,
+                "tokens_oro": 0,
+                "tokens_plata": 100,
+                "verificado": False
+            })
+        except DuplicateKeyError:
+            # Dos registros simultáneos con el mismo alias (índice único)
+            flash("Alias ya registrado")
+            return redirect(url_for("registro"))
         flash("Registro exitoso, inicia sesión")
         return redirect(url_for("login"))
     return render_template("registro.html")
@@ -233,29 +2062,41 @@ from uuid import uuid4
 #     usuario = usuarios_col.find_one({"alias": alias})
 #     return alias, usuario.get("tokens_oro", 0), usuario.get("tokens_plata", 0)
 def delete_old_duels():
-    """Elimina duelos con más de 7 días de antigüedad y sus imágenes asociadas."""
+    """Elimina duelos vencidos y sus imágenes (ver RETENCION["duelos"])."""
     try:
-        limite_fecha = datetime.now() - timedelta(days=7)
-        duelos_viejos = list(fotos_col.find({"fecha": {"$lt": limite_fecha}}))
-
-        for duelo in duelos_viejos:
-            if "player_image" in duelo and duelo["player_image"]:
-                try:
-                    fs.delete(ObjectId(duelo["player_image"]))
-                except Exception as e:
-                    print(f"Error al eliminar imagen de player de GridFS: {e}")
-
-            if "rival_image" in duelo and duelo["rival_image"]:
-                try:
-                    fs.delete(ObjectId(duelo["rival_image"]))
-                except Exception as e:
-                    print(f"Error al eliminar imagen de rival de GridFS: {e}")
-
-        fotos_col.delete_many({"fecha": {"$lt": limite_fecha}})
-        print(f"Se eliminaron {len(duelos_viejos)} duelos antiguos.")
+        reporte = aplicar_retencion("duelos")
+        print(f"Se eliminaron {reporte['documentos']} duelos antiguos.")
     except Exception as e:
         print(f"Error en la tarea de eliminar duelos antiguos: {e}")
 
+DUELOS_POR_PAGINA = 12
+COMENTARIOS_DUELO_PREVIA = 3
+# Los duelos se crean en "pendiente"; nada los pasa a otro estado todavía, pero el feed
+# filtra por igualdad sobre un campo indexado en vez de {"terminado": {"$ne": True}}.
+ESTADO_DUELO_ABIERTO = "pendiente"
+
+def duelos_abiertos(alias, cursor=None, limite=DUELOS_POR_PAGINA):
+    """Página de duelos abiertos sin los arrays completos: trae los conteos, los últimos
+    comentarios y si `alias` ya votó. Devuelve (duelos, next_cursor)."""
+    docs = list(fotos_col.aggregate([
+        {"$match": filtro_cursor(cursor, {"estado": ESTADO_DUELO_ABIERTO})},
+        {"$sort": dict(ORDEN_FEED)},
+        {"$limit": limite + 1},
+        {"$addFields": {
+            # los duelos aún no migrados a cubetas traen los arrays embebidos
+            "total_comentarios": {"$ifNull": ["$total_comentarios", {"$size": {"$ifNull": ["$comentarios", []]}}]},
+            "total_votantes": {"$ifNull": ["$total_votantes", {"$size": {"$ifNull": ["$votantes", []]}}]},
+            "ya_vote": {"$in": [alias, {"$ifNull": ["$votantes.usuario", []]}]},
+            "comentarios": {"$slice": [{"$ifNull": ["$comentarios", []]}, -COMENTARIOS_DUELO_PREVIA]},
+        }},
+        {"$project": {"votantes": 0}},
+    ]))
+    duelos, next_cursor = cortar_pagina(docs, limite)
+    votados = padres_con("fotos_hot.votantes", [d["_id"] for d in duelos], usuario=alias)
+    for d in duelos:
+        d["ya_vote"] = d["ya_vote"] or str(d["_id"]) in votados
+    return duelos, next_cursor
+
 @app.route("/foto_hot", methods=["GET", "POST"])
 def foto_hot():
     alias, tokens_oro, tokens_plata = get_user_and_saldo()
@@ -271,12 +2112,6 @@ def foto_hot():
             flash("Sube una imagen válida (.png, .jpg, .jpeg, .gif)")
             return redirect(url_for("foto_hot"))
 
-        try:
-            file_id = fs.put(file, filename=secure_filename(file.filename), content_type=file.content_type)
-        except Exception as e:
-            flash(f"Error al subir la imagen: {e}")
-            return redirect(url_for("foto_hot"))
-
         duelo = fotos_col.find_one({
             "$or": [
                 {"player": alias, "rival": rival, "estado": "pendiente"},
@@ -284,17 +2119,24 @@ def foto_hot():
             ]
         })
 
+        lado = None
         if duelo:
-            update = {}
             if duelo["player"] == alias and not duelo.get("player_image"):
-                update = {"player_image": str(file_id), "player_tokens": 0, "player_votes": 0}
+                lado = "player"
             elif duelo["rival"] == alias and not duelo.get("rival_image"):
-                update = {"rival_image": str(file_id), "rival_tokens": 0, "rival_votes": 0}
+                lado = "rival"
             else:
                 flash("Ya subiste una foto para este duelo.")
-                fs.delete(file_id)
                 return redirect(url_for("foto_hot"))
 
+        try:
+            file_id = encolar_media(file, secure_filename(file.filename), file.content_type, imagen=True)
+        except Exception as e:
+            flash(f"Error al subir la imagen: {e}")
+            return redirect(url_for("foto_hot"))
+
+        if duelo:
+            update = {f"{lado}_image": str(file_id), f"{lado}_tokens": 0, f"{lado}_votes": 0}
             fotos_col.update_one({"_id": duelo["_id"]}, {"$set": update})
             flash("Foto subida al duelo 🔥")
         else:
@@ -308,26 +2150,38 @@ def foto_hot():
                 "rival_tokens": 0,
                 "rival_votes": 0,
                 "comentarios": [],
-                "fecha": datetime.now(),
-                "estado": "pendiente",
-                "votantes": []
+                "total_comentarios": 0,
+                "total_votantes": 0,
+                "fecha": datetime.utcnow(),
+                "estado": "pendiente"
             })
             flash("Foto subida para un nuevo duelo 🔥")
 
         return redirect(url_for("foto_hot"))
 
-    duelos_pendientes = list(fotos_col.find({
-        "terminado": {"$ne": True}
-    }).sort("fecha", -1))
+    duelos_pendientes, next_cursor = duelos_abiertos(alias)
 
     return render_template(
         "foto_hot.html",
         duelos=duelos_pendientes,
+        next_cursor=next_cursor,
         alias=alias,
         saldo=tokens_oro,
         saldo_plata=tokens_plata
     )
 
+@app.route("/foto_hot/duelos")
+def foto_hot_duelos():
+    """Siguiente página de duelos abiertos para la carga infinita."""
+    alias, _, _ = get_user_and_saldo()
+    if not alias:
+        return jsonify(success=False, message="Debes iniciar sesión"), 401
+    duelos, next_cursor = duelos_abiertos(alias, request.args.get("cursor"), _limite_pedido(DUELOS_POR_PAGINA))
+    html = "".join(render_template("duelo_card.html", d=d, alias=alias) for d in duelos)
+    for d in duelos:
+        d["_id"] = str(d["_id"])
+    return jsonify(items=duelos, next_cursor=next_cursor, html=html)
+
 @app.route("/votar_duelo", methods=["POST"])
 def votar_duelo():
     alias, tokens_oro, _ = get_user_and_saldo()
@@ -341,14 +2195,15 @@ def votar_duelo():
         return jsonify(success=False, message="Lado inválido"), 400
 
     try:
-        duelo = fotos_col.find_one({"_id": ObjectId(duelo_id)})
+        duelo = fotos_col.find_one({"_id": ObjectId(duelo_id)}, {"comentarios": 0})
     except InvalidId:
         return jsonify(success=False, message="ID de duelo inválido"), 400
 
     if not duelo:
         return jsonify(success=False, message="Duelo no encontrado"), 404
 
-    if any(v.get("usuario") == alias for v in duelo.get("votantes", [])):
+    if (any(v.get("usuario") == alias for v in duelo.get("votantes", []))
+            or en_lista("fotos_hot.votantes", duelo["_id"], usuario=alias)):
         return jsonify(success=False, message="Ya votaste"), 403
 
     if tokens_oro < 1:
@@ -366,13 +2221,9 @@ def votar_duelo():
             {"$inc": {"tokens_oro": 1}}
         )
 
-    fotos_col.update_one(
-        {"_id": duelo["_id"]},
-        {
-            "$inc": {f"{lado}_votes": 1},
-            "$push": {"votantes": {"usuario": alias, "lado": lado, "fecha": datetime.now()}}
-        }
-    )
+    agregar_a_lista("fotos_hot.votantes", duelo["_id"],
+                    {"usuario": alias, "lado": lado, "fecha": datetime.now()},
+                    inc={f"{lado}_votes": 1})
     return jsonify(success=True, message="Voto registrado y token transferido")
 
 @app.route("/comentario_duelo", methods=["POST"])
@@ -393,7 +2244,8 @@ def comentario_duelo():
         return jsonify(success=False, message="ID de duelo inválido"), 400
 
     comentario = {"user": alias, "texto": texto, "fecha": datetime.now()}
-    fotos_col.update_one({"_id": ObjectId(duelo_id)}, {"$push": {"comentarios": comentario}})
+    if agregar_a_lista("fotos_hot.comentarios", duelo_id, comentario) is None:
+        return jsonify(success=False, message="Duelo no encontrado"), 404
     return jsonify(success=True)
 
 @app.route("/aceptar_reto", methods=["POST"])
@@ -404,8 +2256,9 @@ def aceptar_reto():
 
     data = request.get_json()
     duelo_id = data.get("dueloId")
+    subida_id = data.get("subidaId")
     imagen_data = data.get("imagen")
-    if not duelo_id or not imagen_data:
+    if not duelo_id or not (subida_id or imagen_data):
         return jsonify(success=False, message="Faltan datos"), 400
 
     try:
@@ -416,11 +2269,12 @@ def aceptar_reto():
     if not duelo or duelo.get("rival") or duelo["player"] == alias:
         return jsonify(success=False, message="Reto no disponible para aceptar"), 403
 
-    header, b64 = imagen_data.split(",", 1)
-    ext = header.split(";")[0].split("/")[1]
-    
-    imagen_binario = base64.b64decode(b64)
-    file_id = fs.put(imagen_binario, filename=f"rival.{ext}", content_type=f"image/{ext}")
+    if subida_id:
+        file_id = consumir_subida(subida_id, alias, "imagen")
+    else:
+        file_id = media_desde_data_url(imagen_data, "rival")
+    if not file_id:
+        return jsonify(success=False, message="Imagen no válida"), 400
 
     fotos_col.update_one(
         {"_id": duelo["_id"]},
@@ -451,17 +2305,18 @@ def eliminar_foto_hot(reto_id):
     
     if duelo.get("player_image"):
         try:
-            fs.delete(ObjectId(duelo["player_image"]))
+            liberar_archivo(duelo["player_image"])
         except Exception as e:
             print(f"Error al eliminar la imagen del player: {e}")
 
     if duelo.get("rival_image"):
         try:
-            fs.delete(ObjectId(duelo["rival_image"]))
+            liberar_archivo(duelo["rival_image"])
         except Exception as e:
             print(f"Error al eliminar la imagen del rival: {e}")
 
     fotos_col.delete_one({"_id": duelo["_id"]})
+    borrar_listas("fotos_hot", [duelo["_id"]])
     flash("Reto eliminado.")
     return redirect(url_for("foto_hot"))
 # ---------------------------------------------------------------------------
@@ -473,6 +2328,28 @@ from flask import send_file
 from bson.objectid import ObjectId
 from flask import send_file
 
+AUDIOS_POR_PAGINA = 20
+COMENTARIOS_POR_PISTA = 5
+
+def comentarios_por_audio(audio_ids, limite=COMENTARIOS_POR_PISTA):
+    """Trae en una sola consulta los últimos `limite` comentarios de cada audio.
+    Devuelve {audio_id: (comentarios en orden cronológico, total)}."""
+    # $topN (MongoDB 5.2+) guarda solo `limite` por grupo: no junta en memoria todos
+    # los comentarios de cada pista ni se acerca al límite de 100 MB de $group.
+    grupos = comentarios_col.aggregate([
+        {"$match": {"audio_id": {"$in": audio_ids}}},
+        {"$group": {
+            "_id": "$audio_id",
+            "comentarios": {"$topN": {
+                "n": limite,
+                "sortBy": {"_id": -1},
+                "output": {"_id": "$_id", "usuario": "$usuario", "comentario": "$comentario", "fecha": "$fecha"},
+            }},
+            "total": {"$sum": 1},
+        }},
+    ])
+    return {g["_id"]: (g["comentarios"][::-1], g["total"]) for g in grupos}
+
 @app.route("/audio_hot", methods=["GET", "POST"])
 def audio_hot():
     alias, tokens_oro, tokens_plata = get_user_and_saldo()
@@ -492,8 +2369,8 @@ def audio_hot():
             flash("Sube un audio válido (mp3, wav, ogg, m4a)")
             return redirect(url_for("audio_hot"))
 
-        # ¡CORRECCIÓN! Usamos GridFS para guardar el archivo
-        file_id = fs.put(file, filename=secure_filename(file.filename), content_type=file.content_type)
+        # ¡CORRECCIÓN! Usamos GridFS para guardar el archivo (en segundo plano)
+        file_id = encolar_media(file, secure_filename(file.filename), file.content_type)
         
         audios_col.insert_one({
             "user": alias,
@@ -507,15 +2384,18 @@ def audio_hot():
         flash("Audio subido con éxito 🔥")
         return redirect(url_for("audio_hot"))
 
-    # GET: Mostrar audios y datos
-    pistas = list(audios_col.find().sort("fecha", -1))
+    # GET: Mostrar audios y datos (paginados, comentarios en una sola consulta)
+    pagina = max(request.args.get("pagina", 1, type=int), 1)
+    pistas = list(audios_col.find().sort("fecha", -1)
+                  .skip((pagina - 1) * AUDIOS_POR_PAGINA).limit(AUDIOS_POR_PAGINA + 1))
+    hay_mas = len(pistas) > AUDIOS_POR_PAGINA
+    pistas = contadores.superponer("audios_hot", pistas[:AUDIOS_POR_PAGINA])
+
+    comentarios = comentarios_por_audio([str(p["_id"]) for p in pistas])
     for pista in pistas:
-        pista["comentarios"] = list(comentarios_col.find({"audio_id": str(pista["_id"])}))
+        pista["comentarios"], pista["total_comentarios"] = comentarios.get(str(pista["_id"]), ([], 0))
 
-    tokens_por_usuario = {
-        u.get("alias"): u.get("tokens", 0)
-        for u in usuarios_col.find({}, {"alias": 1, "tokens": 1})
-    }
+    tokens_por_usuario = tokens_recibidos_por_autor(pista.get("user") for pista in pistas)
 
     historial = list(donaciones_col.find().sort("fecha", -1).limit(10))
 
@@ -525,7 +2405,29 @@ def audio_hot():
                             tokens_plata=tokens_plata,
                             pistas=pistas,
                             tokens_por_usuario=tokens_por_usuario,
-                            historial=historial)
+                            historial=historial,
+                            pagina=pagina,
+                            hay_mas=hay_mas)
+
+
+@app.route("/audio_hot/<audio_id>/comentarios")
+def audio_comentarios(audio_id):
+    """Comentarios anteriores a `antes` (id del comentario más viejo ya mostrado)."""
+    limite = min(request.args.get("limite", 20, type=int), 100)
+    filtro = {"audio_id": audio_id}
+    antes = request.args.get("antes")
+    if antes and is_valid_objectid(antes):
+        filtro["_id"] = {"$lt": ObjectId(antes)}
+    docs = list(comentarios_col.find(filtro).sort("_id", -1).limit(limite + 1))
+    hay_mas = len(docs) > limite
+    docs = docs[:limite][::-1]
+    return jsonify(
+        comentarios=[
+            {"id": str(c["_id"]), "usuario": c.get("usuario"), "comentario": c.get("comentario")}
+            for c in docs
+        ],
+        hay_mas=hay_mas
+    )
 
 
 @app.route("/apoyar_audio", methods=["POST"])
@@ -540,7 +2442,7 @@ def apoyar_audio():
         flash("No puedes apoyarte a ti mismo")
         return redirect(url_for("audio_hot"))
 
-    user = usuarios_col.find_one({"alias": alias})
+    user = usuario_actual()
     if not user:
         flash("Usuario no encontrado")
         return redirect(url_for("audio_hot"))
@@ -553,6 +2455,7 @@ def apoyar_audio():
             "fecha": datetime.now(),
             "tipo": "oro"
         })
+        sumar_tokens_recibidos(autor)
         flash(f"Apoyaste a {autor} con 1 token de oro ✨")
     elif user.get("tokens_plata", 0) >= 1:
         usuarios_col.update_one({"alias": alias}, {"$inc": {"tokens_plata": -1}})
@@ -562,6 +2465,7 @@ def apoyar_audio():
             "fecha": datetime.now(),
             "tipo": "plata"
         })
+        sumar_tokens_recibidos(autor)
         flash(f"Apoyaste a {autor} con 1 token de plata 🤝")
     else:
         flash("No tienes tokens suficientes 💸")
@@ -576,7 +2480,10 @@ def votar_audio(audio_id):
         flash("Inicia sesión para votar")
         return redirect(url_for("login"))
 
-    audios_col.update_one({"_id": ObjectId(audio_id)}, {"$inc": {"votos": 1}})
+    if not is_valid_objectid(audio_id):
+        flash("Audio no encontrado")
+        return redirect(url_for("audio_hot"))
+    contadores.sumar("audios_hot", audio_id, "votos")
     flash("✅ Voto registrado")
     return redirect(url_for("audio_hot"))
 
@@ -603,15 +2510,8 @@ def reaccion_audio(audio_id, tipo):
         flash("Inicia sesión para reaccionar")
         return redirect(url_for("login"))
 
-    existe = reacciones_col.find_one({
-        "audio_id": audio_id,
-        "usuario": alias,
-        "tipo": tipo
-    })
-
-    if existe:
-        flash("Ya reaccionaste con ese tipo a este audio")
-    else:
+    # El índice único (audio_id, usuario, tipo) evita reacciones repetidas
+    try:
         reacciones_col.insert_one({
             "audio_id": audio_id,
             "usuario": alias,
@@ -619,6 +2519,8 @@ def reaccion_audio(audio_id, tipo):
             "fecha": datetime.now()
         })
         flash("🔁 Reacción registrada")
+    except DuplicateKeyError:
+        flash("Ya reaccionaste con ese tipo a este audio")
 
     return redirect(url_for("audio_hot"))
 
@@ -641,11 +2543,12 @@ def audio_hot_eliminar_reto(audio_id):
     # Eliminamos de GridFS
     if "audio" in pista:
         try:
-            fs.delete(ObjectId(pista["audio"]))
+            liberar_archivo(pista["audio"])
         except Exception as e:
             print(f"Error al eliminar de GridFS: {e}")
 
     audios_col.delete_one({"_id": ObjectId(audio_id)})
+    reacciones_col.delete_many({"audio_id": audio_id})
     flash("Audio eliminado correctamente")
     return redirect(url_for("audio_hot"))
 # ---------------------------------------------------------------------------
@@ -702,22 +2605,14 @@ def lanzar():
             "tokens": tokens,
             "fecha": datetime.now(),
             "estado": "pendiente",
-            "votos": []
+            "total_votos": 0,
+            "votos_player": 0,
+            "votos_retado": 0
         })
 
         usuarios_col.update_one({"alias": alias}, {"$inc": {"tokens_oro": -tokens}})
 
-        notificacion = {
-            "tipo": "reto_recibido",
-            "mensaje": f"Has sido retado por {alias} con la pregunta: '{pregunta}'",
-            "leido": False,
-            "fecha": datetime.utcnow()
-        }
-
-        usuarios_col.update_one(
-            {"alias": retado},
-            {"$push": {"notificaciones": notificacion}}
-        )
+        notificar(retado, "reto_recibido", f"Has sido retado por {alias} con la pregunta: '{pregunta}'")
 
         flash("Reto lanzado correctamente 🔥")
         return redirect(url_for("lanzar"))
@@ -732,8 +2627,7 @@ def lanzar():
         ]
     }).sort("fecha", -1))
 
-    usuario = usuarios_col.find_one({"alias": alias})
-    notificaciones = [n for n in usuario.get("notificaciones", []) if not n.get("leido", False)]
+    notificaciones = notificaciones_no_leidas(alias)
     retos_recibidos_pendientes = any(r["estado"] == "pendiente" for r in retos_recibidos)
 
     return render_template("lanzar.html", alias=alias, saldo=tokens_oro,
@@ -745,10 +2639,12 @@ def lanzar():
 @app.route("/eliminar_reto/<reto_id>", methods=["POST"])
 def eliminar_reto(reto_id):
     alias, tokens_oro, _ = get_user_and_saldo()
-    reto = retos_col.find_one({"_id": ObjectId(reto_id)})
+    # borrado condicional: no puede cruzarse con una liquidación del mismo reto
+    reto = retos_col.find_one_and_delete({"_id": ObjectId(reto_id), "player": alias, "estado": "pendiente"})
 
-    if reto and reto["player"] == alias and reto["estado"] == "pendiente":
-        retos_col.delete_one({"_id": ObjectId(reto_id)})
+    if reto:
+        cubetas_col.delete_many({"lista": LISTA_VOTOS_RETOS, "padre": str(reto["_id"])})
+        votos_retos_col.delete_many({"reto_id": reto["_id"]})
         usuarios_col.update_one({"alias": alias}, {"$inc": {"tokens_oro": reto["tokens"]}})
         flash("Reto eliminado y tokens devueltos", "success")
     else:
@@ -756,6 +2652,152 @@ def eliminar_reto(reto_id):
 
     return redirect(url_for("lanzar"))
 
+# ---------------------------------------------------------------------------
+# Liquidación de retos
+# ---------------------------------------------------------------------------
+# Cada voto se registra una sola vez en votos_retos ("<reto>:<alias>" como _id), que es
+# la única copia de los votos, y suma a total_votos/votos_player/votos_retado con $inc
+# mientras el reto esté pendiente. Al llegar a VOTOS_PARA_LIQUIDAR, liquidar_reto() pasa
+# el reto de "pendiente" al resultado con un find_one_and_update: solo el request que
+# gana esa transición paga. Los pagos se anotan en esa misma transición
+# (pagos_pendientes) y se quitan al aplicarse; los que fallan los reintenta el barrido.
+VOTOS_PARA_LIQUIDAR = 3
+
+def migrar_votos_reto(reto):
+    """Pasa a votos_retos los votos de un reto anterior (embebidos en reto.votos o en
+    cubetas) y le deja los contadores. Es idempotente."""
+    cubetas = list(cubetas_col.find({"lista": LISTA_VOTOS_RETOS, "padre": str(reto["_id"])}))
+    if "total_votos" in reto and "votos" not in reto and not cubetas:
+        return
+    votos = list(reto.get("votos") or [])
+    for cubeta in sorted(cubetas, key=lambda c: c["n"]):
+        votos.extend(cubeta.get("items", []))
+    for voto in votos:
+        try:
+            votos_retos_col.insert_one({"_id": f"{reto['_id']}:{voto['alias']}", "reto_id": reto["_id"],
+                                        "ganador": voto.get("ganador"), "fecha": reto.get("fecha")})
+        except DuplicateKeyError:
+            pass
+    # los contadores solo se ponen si el reto no los tenía (si no, ya cuentan esos votos)
+    retos_col.update_one({"_id": reto["_id"], "total_votos": {"$exists": False}}, {"$set": {
+        "total_votos": len(votos),
+        "votos_player": sum(1 for v in votos if v.get("ganador") == reto.get("player")),
+        "votos_retado": sum(1 for v in votos if v.get("ganador") == reto.get("retado")),
+    }})
+    retos_col.update_one({"_id": reto["_id"]}, {"$unset": {"votos": ""}})
+    if cubetas:
+        cubetas_col.delete_many({"_id": {"$in": [c["_id"] for c in cubetas]}})
+
+def migrar_votos_retos(lote=500):
+    """Migra a votos_retos los votos de todos los retos anteriores."""
+    padres = {ObjectId(p) for p in cubetas_col.distinct("padre", {"lista": LISTA_VOTOS_RETOS})}
+    filtro = {"$or": [{"total_votos": {"$exists": False}}, {"votos": {"$exists": True}},
+                      {"_id": {"$in": list(padres)}}]}
+    migrados = 0
+    for reto in retos_col.find(filtro, batch_size=lote):
+        migrar_votos_reto(reto)
+        migrados += 1
+    return migrados
+
+def registrar_voto_reto(reto, alias, ganador):
+    """Devuelve el reto con sus contadores actualizados, "duplicado" si el usuario ya
+    votó o None si el reto ya no admite votos."""
+    # solo si el reto trae marcas de antes (los votos en cubetas los migra migrar-listas)
+    if "votos" in reto or "total_votos" not in reto:
+        migrar_votos_reto(reto)
+    try:
+        votos_retos_col.insert_one({"_id": f"{reto['_id']}:{alias}", "reto_id": reto["_id"],
+                                    "ganador": ganador, "fecha": datetime.utcnow()})
+    except DuplicateKeyError:
+        return "duplicado"
+    reto_act = retos_col.find_one_and_update(
+        {"_id": reto["_id"], "estado": "pendiente", "total_votos": {"$exists": True}},
+        {"$inc": {
+            "total_votos": 1,
+            "votos_player": int(ganador == reto["player"]),
+            "votos_retado": int(ganador == reto["retado"]),
+        }},
+        projection={"total_votos": 1, "votos_player": 1, "votos_retado": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if reto_act is None:
+        votos_retos_col.delete_one({"_id": f"{reto['_id']}:{alias}"})
+    return reto_act
+
+def pagar_reto(reto):
+    """Aplica reto["pagos_pendientes"] en un solo bulk_write y los quita del reto. Se puede
+    repetir sin pagar dos veces: cada usuario guarda en pagos_retos la clave del pago
+    hasta que el reto lo da por hecho. Devuelve True si no quedó nada pendiente."""
+    pagos = reto.get("pagos_pendientes") or []
+    if not pagos:
+        return True
+    claves = [f"{reto['_id']}:{p['alias']}" for p in pagos]
+    try:
+        usuarios_col.bulk_write([
+            UpdateOne({"alias": p["alias"], "pagos_retos": {"$ne": clave}},
+                      {"$inc": {"tokens_oro": p["monto"]}, "$push": {"pagos_retos": clave}})
+            for p, clave in zip(pagos, claves)
+        ], ordered=False)
+        hechos = pagos
+    except BulkWriteError as e:
+        fallidos = {err["index"] for err in e.details.get("writeErrors", [])}
+        hechos = [p for i, p in enumerate(pagos) if i not in fallidos]
+        print(f"Error pagando el reto {reto['_id']}: quedan pendientes {len(fallidos)} pagos")
+    except Exception as e:
+        # no se sabe qué se aplicó: queda todo pendiente y la clave evita el doble pago
+        print(f"Error pagando el reto {reto['_id']}: {pagos} ({e})")
+        return False
+    if hechos:
+        retos_col.update_one({"_id": reto["_id"]}, {"$pull": {"pagos_pendientes": {"alias": {"$in": [p["alias"] for p in hechos]}}}})
+        hechas = [f"{reto['_id']}:{p['alias']}" for p in hechos]
+        usuarios_col.update_many({"alias": {"$in": [p["alias"] for p in hechos]}}, {"$pull": {"pagos_retos": {"$in": hechas}}})
+    return len(hechos) == len(pagos)
+
+def pagar_retos_pendientes():
+    """Reintenta los pagos de retos liquidados que no se pudieron aplicar. Devuelve cuántos retos quedaron pagados."""
+    pagados = 0
+    for reto in retos_col.find({"pagos_pendientes.0": {"$exists": True}}, {"pagos_pendientes": 1}):
+        pagados += pagar_reto(reto)
+    return pagados
+
+def liquidar_reto(reto_id):
+    """Cierra el reto si ya tiene los votos necesarios, anota sus pagos en la misma
+    transición y los aplica en un solo bulk_write (si fallan, quedan en pagos_pendientes
+    para pagar_retos_pendientes). Devuelve el reto liquidado o None si no correspondía
+    (o ya lo liquidó otro)."""
+    reto = retos_col.find_one_and_update(
+        {"_id": reto_id, "estado": "pendiente", "total_votos": {"$gte": VOTOS_PARA_LIQUIDAR}},
+        [
+            {"$set": {
+                "ganador": {"$switch": {
+                    "branches": [
+                        {"case": {"$gt": ["$votos_player", "$votos_retado"]}, "then": "$player"},
+                        {"case": {"$gt": ["$votos_retado", "$votos_player"]}, "then": "$retado"},
+                    ],
+                    "default": None,
+                }},
+                "liquidado": "$$NOW",
+            }},
+            {"$set": {
+                "estado": {"$cond": [
+                    {"$eq": ["$ganador", None]}, "empate", {"$concat": ["ganador: ", "$ganador"]}
+                ]},
+                "pagos_pendientes": {"$cond": [
+                    {"$eq": ["$ganador", None]},
+                    [{"alias": "$player", "monto": "$tokens"}, {"alias": "$retado", "monto": "$tokens"}],
+                    [{"alias": "$ganador", "monto": {"$multiply": ["$tokens", 2]}}],
+                ]},
+            }},
+        ],
+        projection={"player": 1, "retado": 1, "tokens": 1, "estado": 1, "ganador": 1, "pagos_pendientes": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if reto is None:
+        return None
+
+    pagar_reto(reto)
+    return reto
+
 @app.route("/votar_reto/<reto_id>", methods=["POST"])
 def votar_reto(reto_id):
     alias, tokens_oro, _ = get_user_and_saldo()
@@ -777,39 +2819,16 @@ def votar_reto(reto_id):
         flash("Ganador inválido")
         return redirect(url_for("lanzar"))
 
-    votos = reto.get("votos", [])
-    if any(v["alias"] == alias for v in votos):
+    reto_act = registrar_voto_reto(reto, alias, ganador)
+    if reto_act == "duplicado":
         flash("Ya has votado en este reto")
         return redirect(url_for("lanzar"))
+    if reto_act is None:
+        flash("Este reto ya está cerrado")
+        return redirect(url_for("lanzar"))
 
-    votos.append({"alias": alias, "ganador": ganador})
-    retos_col.update_one({"_id": reto["_id"]}, {"$set": {"votos": votos}})
-
-    conteo = {reto["player"]: 0, reto["retado"]: 0}
-    for v in votos:
-        conteo[v["ganador"]] += 1
-
-    if len(votos) >= 3:
-        if conteo[reto["player"]] > conteo[reto["retado"]]:
-            ganador_final = reto["player"]
-        elif conteo[reto["retado"]] > conteo[reto["player"]]:
-            ganador_final = reto["retado"]
-        else:
-            ganador_final = None
-
-        if ganador_final:
-            usuarios_col.update_one(
-                {"alias": ganador_final},
-                {"$inc": {"tokens_oro": reto["tokens"] * 2}}
-            )
-            retos_col.update_one(
-                {"_id": reto["_id"]},
-                {"$set": {"estado": f"ganador: {ganador_final}"}}
-            )
-        else:
-            usuarios_col.update_one({"alias": reto["player"]}, {"$inc": {"tokens_oro": reto["tokens"]}})
-            usuarios_col.update_one({"alias": reto["retado"]}, {"$inc": {"tokens_oro": reto["tokens"]}})
-            retos_col.update_one({"_id": reto["_id"]}, {"$set": {"estado": "empate"}})
+    if reto_act["total_votos"] >= VOTOS_PARA_LIQUIDAR:
+        liquidar_reto(reto["_id"])
 
     flash("Tu voto ha sido registrado ✅")
     return redirect(url_for("lanzar"))
@@ -913,14 +2932,25 @@ def hot_roulette():
         "Haz una pose de modelo seductora",
     ]
 
-    publicaciones = list(publicaciones_col.find().sort("fecha", -1).limit(10))
+    publicaciones, next_cursor = pagina_por_cursor(publicaciones_col, limite=10)
     return render_template(
         "hot_roulette.html",
         retos=retos,
         publicaciones=publicaciones,
+        next_cursor=next_cursor,
         alias=alias
     )
 
+@app.route("/hot_roulette/publicaciones")
+def hot_roulette_publicaciones():
+    alias, _, _ = get_user_and_saldo()
+    publicaciones, next_cursor = pagina_por_cursor(
+        publicaciones_col, request.args.get("cursor"), _limite_pedido(10))
+    html = "".join(render_template("roulette_item.html", pub=p, alias=alias) for p in publicaciones)
+    for p in publicaciones:
+        p["_id"] = str(p["_id"])
+    return jsonify(items=publicaciones, next_cursor=next_cursor, html=html)
+
 @app.route("/hot_roulette/girar", methods=["POST"])
 def hot_roulette_girar():
     alias, _, _ = get_user_and_saldo()
@@ -959,7 +2989,7 @@ def publicar_reto():
     publicaciones_col.insert_one({
         "usuario": alias,
         "reto": reto,
-        "fecha": datetime.now(),
+        "fecha": datetime.utcnow(),
         "likes": 0,
         "dislikes": 0
     })
@@ -975,11 +3005,10 @@ def reaccion_roulette():
     tipo = data.get("tipo")
     if tipo not in ["like", "dislike"]:
         return jsonify(success=False, message="Reacción no válida"), 400
+    if not is_valid_objectid(reto_id):
+        return jsonify(success=False, message="Publicación no encontrada"), 404
     update_field = "likes" if tipo == "like" else "dislikes"
-    publicaciones_col.update_one(
-        {"_id": ObjectId(reto_id)},
-        {"$inc": {update_field: 1}}
-    )
+    contadores.sumar("publicaciones", reto_id, update_field)
     return jsonify(success=True)
 
 # 💡 CORRECCIÓN: Ruta renombrada a aceptar_reto_roulette para evitar conflicto
@@ -999,30 +3028,39 @@ def aceptar_reto_roulette():
 def cumplir_reto():
     alias, _, _ = get_user_and_saldo()
     data = request.get_json()
+    subida_id = data.get("subidaId")
     imagen_data = data.get("imagen")
     reto_id = data.get("retoId")
     if not alias:
         return jsonify(success=False, message="Debes iniciar sesión"), 401
-    if not imagen_data:
+    if not subida_id and not imagen_data:
         return jsonify(success=False, message="Imagen no encontrada")
     try:
-        header, b64 = imagen_data.split(",", 1)
-        ext = header.split("/")[1].split(";")[0]
-        if ext.lower() not in ALLOWED_IMAGE:
-            return jsonify(success=False, message="Formato de imagen no permitido"), 400
-        
-        # ¡CORRECCIÓN! Usamos GridFS para guardar la imagen
-        file_id = fs.put(base64.b64decode(b64), filename=f"{uuid.uuid4().hex}.{ext}", content_type=f"image/{ext}")
-        ruta_relativa = str(file_id)
+        # ¡CORRECCIÓN! La imagen llega por /subir/imagen; el data URL queda por compatibilidad
+        if subida_id:
+            ruta_relativa = consumir_subida(subida_id, alias, "imagen")
+            if not ruta_relativa:
+                return jsonify(success=False, message="Subida no válida"), 400
+        else:
+            ruta_relativa = media_desde_data_url(imagen_data, uuid.uuid4().hex)
+            if not ruta_relativa:
+                return jsonify(success=False, message="Formato de imagen no permitido"), 400
 
-        publicaciones_col.update_one(
+        anterior = publicaciones_col.find_one_and_update(
             {"_id": ObjectId(reto_id)},
             {"$set": {
                 "imagen_cumplimiento": ruta_relativa,
                 "cumplido_por": alias,
                 "fecha_cumplido": datetime.now()
-            }}
+            }},
+            projection={"imagen_cumplimiento": 1}
         )
+        if anterior is None:
+            liberar_archivo(ruta_relativa)
+            return jsonify(success=False, message="Reto no encontrado"), 404
+        # la imagen que reemplaza ya no la usa nadie más
+        if anterior.get("imagen_cumplimiento") and anterior["imagen_cumplimiento"] != ruta_relativa:
+            liberar_archivo(anterior["imagen_cumplimiento"])
         return jsonify(success=True, message="Reto cumplido registrado")
     except Exception as e:
         return jsonify(success=False, message=f"Error: {str(e)}")
@@ -1036,8 +3074,24 @@ def eliminar_cumplido():
     reto_id = data.get("retoId")
     if not reto_id:
         return jsonify(success=False, message="ID del reto no proporcionado"), 400
-    publicacion = publicaciones_col.find_one({"_id": ObjectId(reto_id)})
-    # ... el resto del código parece estar incompleto aquí
+    try:
+        publicacion = publicaciones_col.find_one({"_id": ObjectId(reto_id)})
+    except InvalidId:
+        return jsonify(success=False, message="ID del reto inválido"), 400
+    if not publicacion or publicacion.get("cumplido_por") != alias:
+        return jsonify(success=False, message="No puedes eliminar esta publicación"), 403
+
+    if publicacion.get("imagen_cumplimiento"):
+        try:
+            liberar_archivo(publicacion["imagen_cumplimiento"])
+        except Exception as e:
+            print(f"Error al eliminar la imagen del reto cumplido: {e}")
+
+    publicaciones_col.update_one(
+        {"_id": publicacion["_id"]},
+        {"$unset": {"imagen_cumplimiento": "", "cumplido_por": "", "fecha_cumplido": ""}}
+    )
+    return jsonify(success=True, message="Publicación eliminada")
 # ---------------------------------------------------------------------------
 # Más rutas (lanzar retos, votar, etc.)
 # ---------------------------------------------------------------------------
@@ -1073,7 +3127,7 @@ def adivina():
         flash("Inicia sesión")
         return redirect(url_for("index"))
 
-    textos = list(adivina_col.find().sort("fecha", -1))
+    textos = contadores.superponer("adivina", list(adivina_col.find().sort("fecha", -1)))
     return render_template("adivina.html", textos=textos, alias=alias)
 
 @app.route("/adivina/agregar", methods=["POST"])
@@ -1093,6 +3147,7 @@ def adivina_agregar():
         "texto": texto,
         "fecha": datetime.now(),
         "comentarios": [],
+        "total_comentarios": 0,
         # ✅ Reacciones inicializadas con emojis, consistente con la ruta de reaccionar
         "reacciones": {"👍": 0, "❤️": 0, "😂": 0, "😮": 0, "👎": 0} 
     })
@@ -1119,12 +3174,10 @@ def adivina_comentar():
         "fecha": datetime.now()
     }
 
-    res = adivina_col.update_one(
-        {"_id": ObjectId(conf_id)},
-        {"$push": {"comentarios": comentario}}
-    )
+    if not is_valid_objectid(conf_id):
+        return jsonify({"success": False, "message": "Faltan datos"}), 400
 
-    if res.modified_count == 1:
+    if agregar_a_lista("adivina.comentarios", conf_id, comentario) is not None:
         return jsonify({"success": True, "message": "Comentario agregado"})
     else:
         return jsonify({"success": False, "message": "Error al agregar comentario"})
@@ -1143,17 +3196,11 @@ def adivina_reaccionar():
     # ✅ Validación con los mismos emojis inicializados
     if not conf_id or tipo not in ["👍", "❤️", "😂", "😮", "👎"]:
         return jsonify({"success": False, "message": "Datos de reacción inválidos"}), 400
+    if not is_valid_objectid(conf_id):
+        return jsonify({"success": False, "message": "Error al reaccionar"}), 404
 
-    # Incrementar contador atómico
-    res = adivina_col.update_one(
-        {"_id": ObjectId(conf_id)},
-        {"$inc": {f"reacciones.{tipo}": 1}}
-    )
-
-    if res.modified_count == 1:
-        return jsonify({"success": True, "message": "Reacción registrada"})
-    else:
-        return jsonify({"success": False, "message": "Error al reaccionar"})
+    contadores.sumar("adivina", conf_id, f"reacciones.{tipo}")
+    return jsonify({"success": True, "message": "Reacción registrada"})
 
 # Rutas de confesiones
 # Rutas de confesiones
@@ -1200,12 +3247,13 @@ def confesiones():
 
         if file and allowed_file(file.filename, ALLOWED_MEDIA):
             # 💡 Corrección: Usamos GridFS para guardar el archivo
-            file_id = fs.put(file, filename=secure_filename(file.filename), content_type=file.content_type)
             ext = file.filename.rsplit(".", 1)[1].lower()
-            if ext in ALLOWED_AUDIO:
-                audio = str(file_id)
-            elif ext in ALLOWED_IMG:
+            es_imagen = ext in ALLOWED_IMG
+            file_id = encolar_media(file, secure_filename(file.filename), file.content_type, imagen=es_imagen)
+            if es_imagen:
                 imagen = str(file_id)
+            else:
+                audio = str(file_id)
 
         conf = {
             "usuario": alias,
@@ -1216,22 +3264,28 @@ def confesiones():
             "audio": audio,
             "reacciones": {"❤️": 0, "🔥": 0, "😂": 0, "😮": 0},
             "comentarios": [],
+            "total_comentarios": 0,
         }
         inserted = confesiones_col.insert_one(conf)
+        sumar_ranking(conf["usuario"] or "Anónimo", publicaciones=1)
         conf["_id"] = str(inserted.inserted_id)
         html_card = render_template("confesiones_card.html", conf=conf, alias=alias)
-        return jsonify(success=True, html=html_card)
+        publicar_feed("confesiones", "nueva_confesion", {
+            "id": conf["_id"],
+            "html": render_template("confesiones_card.html", conf=conf, alias=None),
+        })
+        return jsonify(success=True, html=html_card, media_id=imagen or audio)
 
-    todas = list(confesiones_col.find().sort("fecha", -1).limit(20))
+    todas, next_cursor = pagina_por_cursor(confesiones_col, limite=20)
     for c in todas:
         c["_id"] = str(c["_id"])
-    return render_template("confesiones.html", alias=alias, confesiones=todas)
+    return render_template("confesiones.html", alias=alias, confesiones=todas, next_cursor=next_cursor)
 
 @app.route("/reaccion_conf/<id>/<tipo>", methods=["POST"])
 def reaccion_conf(id, tipo):
-    if tipo not in ["❤️", "🔥", "😂", "😮"]:
+    if tipo not in ["❤️", "🔥", "😂", "😮"] or not is_valid_objectid(id):
         return jsonify(success=False)
-    confesiones_col.update_one({"_id": ObjectId(id)}, {"$inc": {f"reacciones.{tipo}": 1}})
+    contadores.sumar("confesiones", id, f"reacciones.{tipo}")
     return jsonify(success=True)
 
 
@@ -1248,7 +3302,8 @@ def comentar_conf():
         "texto": texto,
         "fecha": datetime.now()
     }
-    confesiones_col.update_one({"_id": ObjectId(conf_id)}, {"$push": {"comentarios": comentario}})
+    if not is_valid_objectid(conf_id) or agregar_a_lista("confesiones.comentarios", conf_id, comentario) is None:
+        return jsonify(success=False)
     comentario["fecha"] = comentario["fecha"].isoformat()
     return jsonify(success=True, comentario=comentario)
 
@@ -1261,42 +3316,41 @@ def eliminar_conf(id):
         # 💡 Corrección: Eliminamos de GridFS si existe imagen o audio
         try:
             if conf.get("imagen"):
-                fs.delete(ObjectId(conf["imagen"]))
+                liberar_archivo(conf["imagen"])
             if conf.get("audio"):
-                fs.delete(ObjectId(conf["audio"]))
+                liberar_archivo(conf["audio"])
         except Exception as e:
             print(f"Error al eliminar archivo de GridFS: {e}")
         
-        confesiones_col.delete_one({"_id": ObjectId(id)})
+        if confesiones_col.delete_one({"_id": ObjectId(id)}).deleted_count:
+            sumar_ranking(conf["usuario"], publicaciones=-1)
+            borrar_listas("confesiones", [conf["_id"]])
         return jsonify(success=True)
     return jsonify(success=False, message="No tienes permiso para eliminar esta confesión.")
 
 @app.route("/confesiones/filtro/<tipo>")
 def confesiones_filtro(tipo):
     alias = get_user()
+    next_cursor = None
     if tipo == "populares":
-        confesiones = list(confesiones_col.find().sort("reacciones.🔥", -1).limit(20))
+        confesiones = contadores.superponer("confesiones", list(confesiones_col.find().sort("reacciones.🔥", -1).limit(20)))
     elif tipo == "aleatorio":
-        confesiones = list(confesiones_col.aggregate([{"$sample": {"size": 1}}]))
+        confesiones = contadores.superponer("confesiones", list(confesiones_col.aggregate([{"$sample": {"size": 1}}])))
     else:
-        confesiones = list(confesiones_col.find().sort("fecha", -1).limit(20))
+        confesiones, next_cursor = pagina_por_cursor(confesiones_col, limite=20)
     for c in confesiones:
         c["_id"] = str(c["_id"])
     html = "".join(render_template("confesiones_card.html", conf=c, alias=alias) for c in confesiones)
-    return jsonify({"html": html, "count": len(confesiones)})
+    return jsonify({"html": html, "count": len(confesiones), "next_cursor": next_cursor})
 
 @app.route("/confesiones_scroll")
 def confesiones_scroll():
-    try:
-        offset = int(request.args.get("offset", 0))
-    except ValueError:
-        offset = 0
-    limite = 10
-    confesiones = list(confesiones_col.find().sort("fecha", -1).skip(offset).limit(limite))
+    confesiones, next_cursor = pagina_por_cursor(
+        confesiones_col, request.args.get("cursor"), _limite_pedido(10))
     for c in confesiones:
         c["_id"] = str(c["_id"])
     html_cards = "".join(render_template("confesiones_card.html", conf=c, alias=get_user()) for c in confesiones)
-    return jsonify({"html": html_cards, "count": len(confesiones)})
+    return jsonify(items=confesiones, next_cursor=next_cursor, html=html_cards)
 # ---------------------------------------------------------------------------
 from flask import Flask, render_template, request, redirect, url_for, jsonify, session, flash, send_file
 from werkzeug.utils import secure_filename
@@ -1310,15 +3364,6 @@ import certifi
 from io import BytesIO
 
 
-def get_user_and_saldo():
-    alias = session.get("alias")
-    if not alias:
-        return None, 0, 0
-    user = usuarios_col.find_one({"alias": alias})
-    if user:
-        return alias, int(user.get("tokens_oro", 0)), int(user.get("tokens_plata", 0))
-    return None, 0, 0
-
 
 @app.route('/hot_shorts', methods=['GET', 'POST'])
 def hot_shorts():
@@ -1335,8 +3380,8 @@ def hot_shorts():
             flash("No se envió archivo.", "error")
             return redirect(url_for('hot_shorts'))
         
-        # Guardamos el archivo directamente en GridFS
-        file_id = fs.put(file, filename=secure_filename(file.filename), content_type=file.content_type)
+        # Guardamos el archivo en GridFS en segundo plano
+        file_id = encolar_media(file, secure_filename(file.filename), file.content_type)
         
         reel = {
             "usuario": alias,
@@ -1346,42 +3391,46 @@ def hot_shorts():
             "likes": 0,
             "fuegos": 0,
             "tokens_recibidos": 0,
-            "comentarios": []
+            "comentarios": [],
+            "total_comentarios": 0
         }
         hotreels_col.insert_one(reel)
         flash("Reel subido con éxito!", "success")
         return redirect(url_for('hot_shorts'))
     
-    reels = list(hotreels_col.find().sort("fecha", -1).limit(5))
-    return render_template('hot_shorts.html', reels=reels)
+    reels, next_cursor = pagina_por_cursor(hotreels_col, limite=5)
+    return render_template('hot_shorts.html', reels=reels, next_cursor=next_cursor)
 
 @app.route('/hot_shorts/video/<file_id>')
 def stream_video(file_id):
     try:
-        file = fs.get(ObjectId(file_id))
-        return send_file(BytesIO(file.read()), mimetype=file.content_type)
-    except NoFile:
+        file = obtener_archivo(file_id)
+    except (NoFile, InvalidId):
         return "Archivo no encontrado", 404
     except Exception as e:
         return f"Error al servir el archivo: {e}", 500
+    return responder_gridfs(file)
 
 @app.route('/hot_shorts/load_more', methods=['GET'])
 def load_more_reels():
-    skip = int(request.args.get('skip', 0))
-    limit = int(request.args.get('limit', 5))
-    reels = list(hotreels_col.find().sort("fecha", -1).skip(skip).limit(limit))
+    reels, next_cursor = pagina_por_cursor(hotreels_col, request.args.get('cursor'), _limite_pedido(5))
+    html = "".join(render_template('reel_card.html', reel=r) for r in reels)
     for r in reels:
         r["_id"] = str(r["_id"])
-    return jsonify(reels)
+    return jsonify(items=reels, next_cursor=next_cursor, html=html)
 
 @app.route('/reel/<reel_id>/like', methods=['POST'])
 def like_reel(reel_id):
-    hotreels_col.update_one({"_id": ObjectId(reel_id)}, {"$inc": {"likes": 1}})
+    if not is_valid_objectid(reel_id):
+        return jsonify(success=False), 404
+    contadores.sumar("hotreels", reel_id, "likes")
     return jsonify(success=True)
 
 @app.route('/reel/<reel_id>/fire', methods=['POST'])
 def fire_reel(reel_id):
-    hotreels_col.update_one({"_id": ObjectId(reel_id)}, {"$inc": {"fuegos": 1}})
+    if not is_valid_objectid(reel_id):
+        return jsonify(success=False), 404
+    contadores.sumar("hotreels", reel_id, "fuegos")
     return jsonify(success=True)
 
 @app.route('/reel/<reel_id>/regalar', methods=['POST'])
@@ -1405,7 +3454,7 @@ def regalar_reel(reel_id):
         return jsonify(success=False, message="No tienes tokens de oro suficientes"), 403
 
     usuarios_col.update_one({"alias": alias}, {"$inc": {"tokens_oro": -1}})
-    usuarios_col.update_one({"alias": autor}, {"$inc": {"tokens_oro": 1}})
+    sumar_tokens_recibidos(autor, tokens_oro=1)
     hotreels_col.update_one({"_id": ObjectId(reel_id)}, {"$inc": {"tokens_recibidos": 1}})
     
     donaciones_col.insert_one({
@@ -1430,7 +3479,8 @@ def comentar_reel(reel_id):
         "texto": texto,
         "fecha": datetime.utcnow()
     }
-    hotreels_col.update_one({"_id": ObjectId(reel_id)}, {"$push": {"comentarios": comentario}})
+    if not is_valid_objectid(reel_id) or agregar_a_lista("hotreels.comentarios", reel_id, comentario) is None:
+        return jsonify(success=False, message="Reel no encontrado"), 404
     return jsonify(success=True)
 @app.route('/eliminar_shorts/<reel_id>', methods=['POST'])
 def eliminar_shorts(reel_id):
@@ -1452,12 +3502,13 @@ def eliminar_shorts(reel_id):
         # Borrar video de GridFS si existe
         if reel.get("archivo_id"):
             try:
-                fs.delete(ObjectId(reel["archivo_id"]))
+                liberar_archivo(reel["archivo_id"])
             except Exception as e:
                 print(f"⚠ No se pudo borrar el archivo de GridFS: {e}")
 
         # Borrar documento en MongoDB
         hotreels_col.delete_one({"_id": reel_object_id})
+        borrar_listas("hotreels", [reel_object_id])
 
         return jsonify(success=True, message="Video eliminado con éxito")
     except Exception as e:
@@ -1501,7 +3552,7 @@ def tokens():
         return redirect(url_for('index'))
     
     # Obtener el saldo actual del usuario
-    usuario = usuarios_col.find_one({'alias': alias})
+    usuario = usuario_actual()
     saldo_tokens = usuario.get('tokens_oro', 0) if usuario else 0
 
     return render_template('tokens.html', saldo=saldo_tokens)
@@ -1524,7 +3575,7 @@ def comprar_tokens():
             return redirect(url_for('tokens'))
 
         # 💡 Corrección: Guardar el archivo directamente en GridFS
-        file_id = fs.put(comprobante_file, filename=secure_filename(comprobante_file.filename), content_type=comprobante_file.content_type)
+        file_id = encolar_media(comprobante_file, secure_filename(comprobante_file.filename), comprobante_file.content_type)
         
         # Guardar la solicitud en la base de datos
         compra = {
@@ -1574,15 +3625,34 @@ def get_gravatar_hash(alias):
     """Calcula el hash MD5 para Gravatar."""
     return hashlib.md5(alias.lower().encode('utf-8')).hexdigest()
 
+# alias -> id del avatar ('default' si no tiene); cambiar_avatar invalida su entrada
+cache_avatares = CacheTTL(ttl=int(os.getenv("AVATAR_CACHE_TTL", 60)))
+
+def _url_avatar(user_alias, avatar):
+    if avatar and avatar != 'default':
+        return url_for('stream_avatar', file_id=avatar, w=64)
+    gravatar_hash = get_gravatar_hash(user_alias)
+    return f"https://www.gravatar.com/avatar/{gravatar_hash}?d=identicon&s=64"
+
+def resolver_avatares(aliases):
+    """URLs de avatar de varios alias con una sola consulta $in para los que no están en caché."""
+    aliases = set(a for a in aliases if a)
+    avatares = cache_avatares.get_many(aliases)
+    faltan = aliases - avatares.keys()
+    if faltan:
+        leidos = {
+            u['alias']: u.get('avatar', 'default')
+            for u in usuarios_col.find({'alias': {'$in': list(faltan)}}, {'alias': 1, 'avatar': 1})
+        }
+        for alias in faltan:
+            avatares[alias] = leidos.get(alias, 'default')
+            cache_avatares.set(alias, avatares[alias])
+    return {alias: _url_avatar(alias, avatar) for alias, avatar in avatares.items()}
+
 @app.template_filter('avatar_url')
 def avatar_url_filter(user_alias):
     """Genera la URL del avatar, usando uno personalizado si existe."""
-    user = usuarios_col.find_one({'alias': user_alias})
-    if user and 'avatar' in user and user['avatar'] != 'default':
-        return url_for('stream_avatar', file_id=user['avatar'])
-    else:
-        gravatar_hash = get_gravatar_hash(user_alias)
-        return f"https://www.gravatar.com/avatar/{gravatar_hash}?d=identicon&s=64"
+    return resolver_avatares([user_alias]).get(user_alias) or _url_avatar(user_alias or '', None)
 
 @app.template_filter('gravatar')
 def gravatar_filter(s):
@@ -1593,16 +3663,163 @@ def sanitize_for_pusher(name):
     """Elimina caracteres no válidos para nombres de canales de Pusher."""
     return re.sub(r'[^a-zA-Z0-9_\-=@,.;]+', '', name)
 
+MENSAJES_POR_PAGINA = int(os.getenv("MENSAJES_POR_PAGINA", 50))
+
+def sala_chat(a, b):
+    return "_".join(sorted([sanitize_for_pusher(a), sanitize_for_pusher(b or '')]))
+
+# Historial del chat en cubetas: cada sala guarda sus mensajes en documentos
+# {sala, n, cuenta, desde, hasta, mensajes, archivos} de TAM_CUBETA_CHAT mensajes
+# y salas_col lleva {_id: sala, total}. El mensaje i vive en la cubeta i // TAM_CUBETA_CHAT
+# y el cursor del historial es esa posición ("los anteriores a i").
+# Las salas que todavía tienen mensajes sueltos en mensajes_col se migran al tocarlas:
+# quien migra reclama antes la sala ({estado: "migrando"}) y nadie escribe en sus
+# cubetas hasta que tiene total.
+TAM_CUBETA_CHAT = int(os.getenv("TAM_CUBETA_CHAT", 100))
+# Segundos tras los que una migración sin terminar se da por abandonada y se retoma
+SALA_MIGRANDO_MAX = 300
+
+def _item_mensaje(m):
+    ts = m.get("ts") or m["_id"].generation_time.replace(tzinfo=None)
+    return {"from": m["from"], "tipo": m.get("tipo", "text"), "message": m.get("message"), "ts": ts}
+
+def _guardar_en_cubeta_chat(sala, n, cambios):
+    filtro = {"sala": sala, "n": n}
+    try:
+        cubetas_chat_col.update_one(filtro, cambios, upsert=True)
+    except DuplicateKeyError:
+        cubetas_chat_col.update_one(filtro, cambios)
+
+def migrar_sala(sala):
+    """Pasa los mensajes sueltos de la sala a cubetas. Devuelve cuántos migró
+    (0 si ya estaba migrada o la está migrando otro proceso)."""
+    ahora = datetime.utcnow()
+    try:
+        salas_col.insert_one({"_id": sala, "estado": "migrando", "reclamada": ahora})
+    except DuplicateKeyError:
+        # ya migrada, o en manos de otro; una migración abandonada se retoma
+        retomada = salas_col.find_one_and_update(
+            {"_id": sala, "estado": "migrando",
+             "reclamada": {"$lt": ahora - timedelta(seconds=SALA_MIGRANDO_MAX)}},
+            {"$set": {"reclamada": ahora}}
+        )
+        if retomada is None:
+            return 0
+    viejos = list(mensajes_col.find({"sala": sala}))
+    items = sorted((_item_mensaje(m) for m in viejos), key=lambda i: i["ts"])
+    for n in range(0, len(items), TAM_CUBETA_CHAT):
+        grupo = items[n:n + TAM_CUBETA_CHAT]
+        _guardar_en_cubeta_chat(sala, n // TAM_CUBETA_CHAT, {"$set": {
+            "mensajes": grupo,
+            "cuenta": len(grupo),
+            "desde": grupo[0]["ts"],
+            "hasta": grupo[-1]["ts"],
+            "archivos": [i["message"] for i in grupo if i["tipo"] in ("image", "audio")],
+        }})
+    terminada = salas_col.update_one(
+        {"_id": sala, "estado": "migrando", "reclamada": ahora},
+        {"$set": {"estado": "lista", "total": len(items)}, "$unset": {"reclamada": ""}}
+    )
+    if not terminada.modified_count:
+        return 0  # la retomó otro proceso: él la termina
+    if viejos:
+        mensajes_col.delete_many({"_id": {"$in": [m["_id"] for m in viejos]}})
+    return len(items)
+
+def _esperar_sala(sala, intentos=40):
+    """Se asegura de que la sala esté migrada (migrándola o esperando a quien la migra).
+    Devuelve False si después de ~2 s sigue a medias."""
+    for _ in range(intentos):
+        if salas_col.find_one({"_id": sala, "total": {"$exists": True}}, {"_id": 1}):
+            return True
+        migrar_sala(sala)
+        if salas_col.find_one({"_id": sala, "total": {"$exists": True}}, {"_id": 1}):
+            return True
+        time.sleep(0.05)
+    return False
+
+def agregar_mensaje(sala, de, tipo, mensaje):
+    """Agrega un mensaje al final de la sala ($inc del total y $push en su cubeta).
+    Devuelve el mensaje, o None si la sala se está migrando todavía."""
+    item = {"from": de, "tipo": tipo, "message": mensaje, "ts": datetime.utcnow()}
+    filtro = {"_id": sala, "total": {"$exists": True}}
+    doc = salas_col.find_one_and_update(filtro, {"$inc": {"total": 1}}, return_document=ReturnDocument.AFTER)
+    if doc is None:
+        if not _esperar_sala(sala):
+            return None
+        doc = salas_col.find_one_and_update(filtro, {"$inc": {"total": 1}}, return_document=ReturnDocument.AFTER)
+    cambios = {
+        "$push": {"mensajes": item},
+        "$inc": {"cuenta": 1},
+        "$min": {"desde": item["ts"]},
+        "$max": {"hasta": item["ts"]},
+    }
+    if tipo in ("image", "audio"):
+        cambios["$push"]["archivos"] = mensaje
+    _guardar_en_cubeta_chat(sala, (doc["total"] - 1) // TAM_CUBETA_CHAT, cambios)
+    return item
+
+def posicion_chat(cursor):
+    """Cursor del historial -> posición, o None para empezar por lo más nuevo."""
+    if not cursor:
+        return None
+    if not cursor.isdigit():
+        raise CursorInvalido(cursor)
+    return int(cursor)
+
+def leer_mensajes(sala, antes=None, limite=MENSAJES_POR_PAGINA):
+    """Hasta `limite` mensajes anteriores a la posición `antes`, del más viejo al más nuevo,
+    recorriendo las cubetas desde la más nueva. Devuelve (mensajes, next_cursor)."""
+    if not salas_col.find_one({"_id": sala, "total": {"$exists": True}}, {"_id": 1}):
+        _esperar_sala(sala)
+    filtro = {"sala": sala}
+    if antes is not None:
+        filtro["n"] = {"$lte": (antes - 1) // TAM_CUBETA_CHAT}
+    pagina, primera = [], None
+    for cubeta in cubetas_chat_col.find(filtro, {"n": 1, "mensajes": 1}).sort("n", DESCENDING):
+        base = cubeta["n"] * TAM_CUBETA_CHAT
+        for i in range(len(cubeta.get("mensajes", [])) - 1, -1, -1):
+            if antes is not None and base + i >= antes:
+                continue
+            pagina.append(cubeta["mensajes"][i])
+            primera = base + i
+            if len(pagina) == limite:
+                break
+        if len(pagina) == limite:
+            break
+    pagina.reverse()
+    siguiente = str(primera) if len(pagina) == limite and primera else None
+    return pagina, siguiente
+
+def migrar_mensajes(lote=500):
+    """Migra a cubetas todas las salas que aún tienen mensajes sueltos. Lo que quede
+    suelto en salas ya migradas (un proceso que cayó antes de borrarlo) ya está
+    copiado en las cubetas y se borra aquí."""
+    migrados = 0
+    grupos = mensajes_col.aggregate([{"$group": {"_id": "$sala"}}], allowDiskUse=True, batchSize=lote)
+    for grupo in grupos:
+        sala = grupo["_id"]
+        migrados += migrar_sala(sala)
+        if salas_col.find_one({"_id": sala, "estado": {"$ne": "migrando"}, "total": {"$exists": True}}, {"_id": 1}):
+            mensajes_col.delete_many({"sala": sala})
+    return migrados
+
+@app.cli.command("migrar-mensajes")
+@click.option("--lote", default=500, show_default=True, help="Salas por lote.")
+def migrar_mensajes_command(lote):
+    """Pasa los mensajes del chat de mensajes_col a cubetas por sala."""
+    click.echo(f"Mensajes migrados: {migrar_mensajes(lote)}")
+
 # --- Rutas de la aplicación ---
 
 @app.route('/avatar/<file_id>')
 def stream_avatar(file_id):
     """Ruta para servir avatares desde GridFS."""
     try:
-        file = fs.get(ObjectId(file_id))
-        return send_file(BytesIO(file.read()), mimetype=file.content_type, as_attachment=False)
-    except NoFile:
+        file = elegir_variante(obtener_archivo(file_id))
+    except (NoFile, InvalidId):
         return abort(404)
+    return responder_gridfs(file)
 
 @app.route('/cambiar_avatar', methods=['POST'])
 def cambiar_avatar():
@@ -1616,14 +3833,97 @@ def cambiar_avatar():
         return redirect(url_for('perfiles'))
 
     if allowed_file(archivo.filename, ALLOWED_AVATAR):
-        file_id = fs.put(archivo, filename=secure_filename(f"{uuid.uuid4().hex}_{archivo.filename}"), content_type=archivo.content_type)
-        usuarios_col.update_one({'alias': session['alias']}, {'$set': {'avatar': str(file_id)}})
+        file_id = encolar_media(archivo, secure_filename(f"{uuid.uuid4().hex}_{archivo.filename}"), archivo.content_type, imagen=True)
+        anterior = usuarios_col.find_one_and_update(
+            {'alias': session['alias']},
+            {'$set': {'avatar': str(file_id)}},
+            projection={'avatar': 1}
+        )
+        cache_avatares.invalidar(session['alias'])
+        if anterior and anterior.get('avatar') not in (None, 'default'):
+            try:
+                liberar_archivo(anterior['avatar'])
+            except Exception as e:
+                print(f"Error al liberar el avatar anterior: {e}")
         flash("Avatar actualizado correctamente")
     else:
         flash("Formato de imagen no permitido. Usa .png, .jpg o .jpeg")
 
     return redirect(url_for('perfiles'))
 
+# ---------------------------------------------------------------------------
+# Ranking de perfiles
+# ---------------------------------------------------------------------------
+# ranking: {_id: alias, publicaciones, followers, following}. Se mantiene con $inc
+# al publicar/borrar confesiones y al seguir/dejar de seguir; reconstruir_ranking()
+# lo recalcula desde cero por si algún contador se desvía. Los seguimientos son
+# documentos {seguidor, seguido} en seguimientos_col (uno por relación).
+PERFILES_POR_PAGINA = int(os.getenv("PERFILES_POR_PAGINA", 30))
+RANKING_INTERVALO = int(os.getenv("RANKING_INTERVALO", 24 * 3600))
+
+def sumar_ranking(alias, **deltas):
+    ranking_col.update_one({"_id": alias}, {"$inc": deltas}, upsert=True)
+
+def reconstruir_ranking():
+    """Recalcula el ranking en un solo $merge a partir de seguimientos y confesiones."""
+    ahora = datetime.utcnow()
+    seguimientos_col.aggregate([
+        {"$project": {"_id": 0, "alias": "$seguido", "followers": {"$literal": 1}}},
+        {"$unionWith": {"coll": seguimientos_col.name, "pipeline": [
+            {"$project": {"_id": 0, "alias": "$seguidor", "following": {"$literal": 1}}},
+        ]}},
+        {"$unionWith": {"coll": confesiones_col.name, "pipeline": [
+            {"$project": {"_id": 0, "alias": {"$ifNull": ["$usuario", "Anónimo"]}, "publicaciones": {"$literal": 1}}},
+        ]}},
+        {"$group": {
+            "_id": "$alias",
+            "publicaciones": {"$sum": "$publicaciones"},
+            "followers": {"$sum": "$followers"},
+            "following": {"$sum": "$following"},
+        }},
+        {"$addFields": {"reconstruido": ahora}},
+        {"$merge": {"into": ranking_col.name, "on": "_id", "whenMatched": "merge", "whenNotMatched": "insert"}},
+    ])
+    # los que ya no tienen confesiones ni seguimientos
+    ranking_col.update_many(
+        {"reconstruido": {"$ne": ahora}},
+        {"$set": {"publicaciones": 0, "followers": 0, "following": 0}}
+    )
+
+def _programador_ranking():
+    while True:
+        try:
+            if _tomar_turno("ranking", RANKING_INTERVALO):
+                reconstruir_ranking()
+        except Exception as e:
+            print(f"Error reconstruyendo el ranking: {e}")
+        time.sleep(RANKING_INTERVALO)
+
+if os.getenv("RANKING_AUTOMATICO", "0") == "1":
+    threading.Thread(target=_programador_ranking, name="ranking", daemon=True).start()
+
+@app.cli.command("ranking")
+def ranking_command():
+    """Reconstruye el ranking de perfiles."""
+    reconstruir_ranking()
+    click.echo(f"Ranking reconstruido: {ranking_col.count_documents({'publicaciones': {'$gt': 0}})} autores.")
+
+@app.cli.command("programador")
+def programador_command():
+    """Crea los índices y corre en primer plano las tareas periódicas (retención,
+    ingestas vencidas, ranking). Va en un proceso aparte de los workers web;
+    si hay varios, _tomar_turno evita que dos corran la misma tarea a la vez."""
+    _indices_al_iniciar()
+    hilos = [
+        threading.Thread(target=_programador_retencion, name="retencion", daemon=True),
+        threading.Thread(target=_programador_ranking, name="ranking", daemon=True),
+    ]
+    for hilo in hilos:
+        hilo.start()
+    click.echo("Programador en marcha (Ctrl+C para salir)")
+    for hilo in hilos:
+        hilo.join()
+
 @app.route('/perfiles')
 def perfiles():
     alias = session.get('alias')
@@ -1631,42 +3931,63 @@ def perfiles():
         flash("Debes iniciar sesión")
         return redirect(url_for('login'))
 
-    usuarios = [c.get('usuario', 'Anónimo') for c in confesiones_col.find()]
-    top = Counter(usuarios).most_common()
+    pagina = max(request.args.get('pagina', 1, type=int), 1)
+    offset = (pagina - 1) * PERFILES_POR_PAGINA
+    top = list(ranking_col.find({'publicaciones': {'$gt': 0}})
+               .sort([('publicaciones', -1), ('_id', 1)])
+               .skip(offset).limit(PERFILES_POR_PAGINA + 1))
+    hay_mas = len(top) > PERFILES_POR_PAGINA
+    top = top[:PERFILES_POR_PAGINA]
+
+    aliases = [r['_id'] for r in top]
+    docs = {
+        u['alias']: u
+        for u in usuarios_col.find({'alias': {'$in': aliases}},
+                                   {'alias': 1, 'tokens_oro': 1, 'avatar': 1, 'verificado': 1})
+    }
+    # a quién de esta página sigo, sin traer mi lista completa de following
+    sigo = {
+        s['seguido']
+        for s in seguimientos_col.find({'seguidor': alias, 'seguido': {'$in': aliases}}, {'seguido': 1})
+    }
 
     perfiles = []
-    me_doc = usuarios_col.find_one({'alias': alias})
-    me_following = me_doc.get('following', []) if me_doc else []
-
-    for i, (usuario, pubs) in enumerate(top, start=1):
-        doc = usuarios_col.find_one({'alias': usuario}) or {}
+    for i, fila in enumerate(top, start=offset + 1):
+        usuario = fila['_id']
+        doc = docs.get(usuario, {})
         perfiles.append({
             'usuario': usuario,
-            'publicaciones': pubs,
+            'publicaciones': fila.get('publicaciones', 0),
             'rank': i,
             'token_oro': doc.get('tokens_oro', 0),
-            'followers': len(doc.get('followers', [])),
-            'following': len(doc.get('following', [])),
-            'is_following': usuario in me_following,
+            'followers': fila.get('followers', 0),
+            'following': fila.get('following', 0),
+            'is_following': usuario in sigo,
             'avatar': doc.get('avatar', 'default'),
             'verificado': doc.get('verificado', False),
         })
 
-    return render_template('perfiles.html', perfiles=perfiles, me=alias)
+    return render_template('perfiles.html', perfiles=perfiles, me=alias, pagina=pagina, hay_mas=hay_mas)
 
 @app.route('/follow/<usuario>', methods=['POST'])
 def follow(usuario):
     me = session.get('alias')
-    if me and me != usuario:
-        usuarios_col.update_one({'alias': me}, {'$addToSet': {'following': usuario}})
-        usuarios_col.update_one({'alias': usuario}, {'$addToSet': {'followers': me}})
+    if me and me != usuario and usuarios_col.count_documents({'alias': usuario}, limit=1):
+        try:
+            seguimientos_col.insert_one({'seguidor': me, 'seguido': usuario, 'fecha': datetime.utcnow()})
+        except DuplicateKeyError:
+            pass  # ya lo seguía
+        else:
+            sumar_ranking(usuario, followers=1)
+            sumar_ranking(me, following=1)
     return redirect(url_for('perfiles'))
 
 @app.route('/unfollow/<usuario>', methods=['POST'])
 def unfollow(usuario):
     me = session.get('alias')
-    usuarios_col.update_one({'alias': me}, {'$pull': {'following': usuario}})
-    usuarios_col.update_one({'alias': usuario}, {'$pull': {'followers': me}})
+    if seguimientos_col.delete_one({'seguidor': me, 'seguido': usuario}).deleted_count:
+        sumar_ranking(usuario, followers=-1)
+        sumar_ranking(me, following=-1)
     return redirect(url_for('perfiles'))
 
 @app.route('/chat/<target>')
@@ -1675,31 +3996,52 @@ def chat(target):
         return redirect(url_for('login'))
     me = session['alias']
     
-    sala = "_".join(sorted([sanitize_for_pusher(me), sanitize_for_pusher(target)]))
-    mensajes = list(mensajes_col.find({'sala': sala}).sort('timestamp', 1))
+    sala = sala_chat(me, target)
+    mensajes, next_cursor = leer_mensajes(sala)
 
+    avatares = resolver_avatares({m['from'] for m in mensajes} | {me, target})
     for m in mensajes:
-        m['avatar_url'] = avatar_url_filter(m['from'])
-    me_avatar_url = avatar_url_filter(me)
-    target_avatar_url = avatar_url_filter(target)
+        m['avatar_url'] = avatares.get(m['from']) or avatar_url_filter(m['from'])
+    me_avatar_url = avatares[me]
+    target_avatar_url = avatares[target]
     
     return render_template('chat.html',
                            me=me,
                            target=target,
                            mensajes=mensajes,
+                           next_cursor=next_cursor,
                            me_avatar_url=me_avatar_url,
                            target_avatar_url=target_avatar_url,
+                           tiempo_real=TIEMPO_REAL,
                            pusher_key=os.getenv("PUSHER_KEY", "24aebba9248c791c8722"),
                            pusher_cluster=os.getenv("PUSHER_CLUSTER", "mt1"))
 
+@app.route('/chat/<target>/mensajes')
+def chat_mensajes(target):
+    """Mensajes anteriores a `before` (cursor de la página previa), del más viejo al más nuevo."""
+    me = session.get('alias')
+    if not me:
+        return jsonify(success=False, message="No autorizado"), 401
+    mensajes, next_cursor = leer_mensajes(sala_chat(me, target), posicion_chat(request.args.get('before')),
+                                          _limite_pedido(MENSAJES_POR_PAGINA, 200))
+    avatares = resolver_avatares({m['from'] for m in mensajes})
+    items = [{
+        'from': m['from'],
+        'message': m.get('message'),
+        'tipo': m.get('tipo', 'text'),
+        'ts': m['ts'].isoformat() if isinstance(m.get('ts'), datetime) else None,
+        'avatar_url': avatares.get(m['from']),
+    } for m in mensajes]
+    return jsonify(items=items, next_cursor=next_cursor)
+
 @app.route('/chat_media/<file_id>')
 def stream_chat_media(file_id):
     """Ruta para servir archivos de chat desde GridFS."""
     try:
-        file = fs.get(ObjectId(file_id))
-        return send_file(BytesIO(file.read()), mimetype=file.content_type, as_attachment=False)
-    except NoFile:
+        file = elegir_variante(obtener_archivo(file_id))
+    except (NoFile, InvalidId):
         return abort(404)
+    return responder_gridfs(file, privado=True)
 
 @app.route('/send_message', methods=['POST'])
 def send_message():
@@ -1710,7 +4052,7 @@ def send_message():
     msg_text = request.form.get('message', '').strip()
     timestamp = request.form.get('timestamp')
     
-    sala = "_".join(sorted([sanitize_for_pusher(from_user), sanitize_for_pusher(to_user)]))
+    sala = sala_chat(from_user, to_user)
     
     tipo = 'text'
     mensaje_a_guardar = msg_text
@@ -1718,10 +4060,11 @@ def send_message():
     if 'media' in request.files:
         media_file = request.files['media']
         if media_file and allowed_file(media_file.filename, ALLOWED_CHAT):
-            file_id = fs.put(media_file, filename=secure_filename(f"{from_user}_{int(time.time())}_{media_file.filename}"), content_type=media_file.content_type)
-            mensaje_a_guardar = str(file_id)
+            nombre = secure_filename(f"{from_user}_{int(time.time())}_{media_file.filename}")
             ext = media_file.filename.rsplit('.', 1)[1].lower()
             tipo = 'image' if ext in {'png', 'jpg', 'jpeg', 'gif'} else 'audio'
+            file_id = encolar_media(media_file, nombre, media_file.content_type, imagen=(tipo == 'image'))
+            mensaje_a_guardar = str(file_id)
             msg_text = ''
         elif media_file:
             return 'Archivo no permitido', 400
@@ -1729,18 +4072,14 @@ def send_message():
     if not msg_text and tipo == 'text':
         return 'Mensaje vacío', 400
 
-    mensajes_col.insert_one({
-        'sala': sala,
-        'from': from_user,
-        'to': to_user,
-        'message': mensaje_a_guardar,
-        'tipo': tipo,
-        'timestamp': timestamp
-    })
+    if agregar_mensaje(sala, from_user, tipo, mensaje_a_guardar) is None:
+        if tipo != 'text':
+            liberar_archivo(mensaje_a_guardar)
+        return 'Intenta de nuevo en unos segundos', 503
 
     from_user_avatar_url = avatar_url_filter(from_user)
 
-    pusher_client.trigger(sala, 'receive_message', {
+    despachador_eventos.encolar(sala, 'receive_message', {
         'from': from_user,
         'to': to_user,
         'message': mensaje_a_guardar,
@@ -1750,6 +4089,62 @@ def send_message():
     })
 
     return 'OK'
+
+# ---------------------------------------------------------------------------
+# Gateway de tiempo real (Flask-SocketIO)
+# ---------------------------------------------------------------------------
+# Solo se conectan sesiones con alias. Cada socket entra a su sala personal
+# (notificaciones, estado de subidas) y pide con "unirse" la sala de un chat en el
+# que participa o el canal de un feed. Solo se listan los feeds que publican algo.
+FEEDS_TIEMPO_REAL = {"confesiones"}
+
+def sala_usuario(alias):
+    return f"usuario:{alias}"
+
+def sala_feed(feed):
+    return f"feed:{feed}"
+
+def _sala_pedida(alias, datos):
+    """Sala a la que el alias puede unirse según `datos` ({chat: alias} o {feed: nombre})."""
+    if not isinstance(datos, dict):
+        return None
+    if datos.get("chat"):
+        return sala_chat(alias, str(datos["chat"]))
+    if datos.get("feed") in FEEDS_TIEMPO_REAL:
+        return sala_feed(datos["feed"])
+    return None
+
+def publicar_feed(feed, evento, datos):
+    """Avisa a los que miran un feed (p. ej. una publicación nueva)."""
+    try:
+        socketio.emit(evento, datos, to=sala_feed(feed))
+    except Exception as e:
+        print(f"Error publicando en el feed {feed}: {e}")
+
+@socketio.on("connect")
+def tiempo_real_conectar(auth=None):
+    alias = session.get("alias")
+    if not alias:
+        return False  # rechaza la conexión
+    join_room(sala_usuario(alias))
+
+@socketio.on("unirse")
+def tiempo_real_unirse(datos):
+    alias = session.get("alias")
+    sala = _sala_pedida(alias, datos) if alias else None
+    if not sala:
+        return {"success": False}
+    join_room(sala)
+    return {"success": True, "sala": sala}
+
+@socketio.on("salir")
+def tiempo_real_salir(datos):
+    alias = session.get("alias")
+    sala = _sala_pedida(alias, datos) if alias else None
+    if not sala:
+        return {"success": False}
+    leave_room(sala)
+    return {"success": True}
 # -----------------------
 # FORMULARIO DE VERIFICACIÓN
 # -----------------------
@@ -1789,14 +4184,14 @@ def verificar():
         selfie_ine_id = None
 
         if ine_frontal:
-            ine_frontal_id = fs.put(ine_frontal, filename=f"{alias}_ine_frontal", content_type=ine_frontal.content_type)
+            ine_frontal_id = encolar_media(ine_frontal, f"{alias}_ine_frontal", ine_frontal.content_type)
         if ine_trasera:
-            ine_trasera_id = fs.put(ine_trasera, filename=f"{alias}_ine_trasera", content_type=ine_trasera.content_type)
+            ine_trasera_id = encolar_media(ine_trasera, f"{alias}_ine_trasera", ine_trasera.content_type)
         if selfie_ine:
-            selfie_ine_id = fs.put(selfie_ine, filename=f"{alias}_selfie_ine", content_type=selfie_ine.content_type)
+            selfie_ine_id = encolar_media(selfie_ine, f"{alias}_selfie_ine", selfie_ine.content_type)
         
         # Marcar como verificado en Mongo y guardar los datos de verificación
-        usuarios_col.update_one(
+        anterior = usuarios_col.find_one_and_update(
             {"alias": alias},
             {"$set": {
                 "verificado": True,
@@ -1806,8 +4201,16 @@ def verificar():
                 "ine_frontal_id": str(ine_frontal_id),
                 "ine_trasera_id": str(ine_trasera_id),
                 "selfie_ine_id": str(selfie_ine_id)
-            }}
+            }},
+            projection={"ine_frontal_id": 1, "ine_trasera_id": 1, "selfie_ine_id": 1}
         )
+        # los documentos de una verificación anterior se reemplazan: se sueltan
+        nuevos = {str(ine_frontal_id), str(ine_trasera_id), str(selfie_ine_id)}
+        anterior = anterior or {}
+        liberar_archivos([
+            anterior.get(c) for c in ("ine_frontal_id", "ine_trasera_id", "selfie_ine_id")
+            if anterior.get(c) and is_valid_objectid(anterior[c]) and anterior[c] not in nuevos
+        ])
 
         flash("✅ Verificación enviada correctamente.")
         return redirect(url_for("perfiles"))
@@ -1824,7 +4227,8 @@ def retiro():
         flash("Debes iniciar sesión para retirar tokens.")
         return redirect(url_for("login"))
 
-    user = usuarios_col.find_one({"alias": alias})
+    # los datos de pago no están en CAMPOS_USUARIO
+    user = usuario_actual("nombre", "cuenta_bancaria", "correo")
     if not user:
         flash("Usuario no encontrado.")
         return redirect(url_for("perfiles"))
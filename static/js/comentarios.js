@@ -0,0 +1,60 @@
+// "Ver comentarios anteriores": los padres embeben solo los últimos comentarios y el
+// resto se pide a /comentarios/<coleccion>/<id>?antes=<posición> por tandas.
+(function() {
+    function elemento(tag, clase, texto) {
+        const el = document.createElement(tag);
+        if (clase) el.className = clase;
+        if (texto !== undefined) el.textContent = texto;
+        return el;
+    }
+
+    // Cada pantalla pinta sus comentarios a su manera
+    const formatos = {
+        confesiones: c => {
+            const div = elemento('div', 'comentario-item');
+            div.appendChild(elemento('span', 'comentario-usuario', c.usuario + ':'));
+            div.appendChild(elemento('span', 'comentario-texto', c.texto));
+            return div;
+        },
+        hotreels: c => elemento('p', '', '💬 ' + c.texto),
+        fotos_hot: c => {
+            const p = elemento('p');
+            p.appendChild(elemento('strong', '', c.usuario + ':'));
+            p.appendChild(document.createTextNode(' ' + c.texto));
+            return p;
+        },
+        adivina: c => {
+            const div = elemento('div', 'comentario-item');
+            div.appendChild(elemento('strong', 'comentario-user', c.usuario));
+            div.appendChild(document.createTextNode(': '));
+            div.appendChild(elemento('span', '', c.texto));
+            div.appendChild(document.createElement('br'));
+            if (c.fecha) {
+                div.appendChild(elemento('small', 'fecha-info', new Date(c.fecha).toLocaleString('es-MX')));
+            }
+            return div;
+        }
+    };
+
+    document.addEventListener('click', function(e) {
+        const boton = e.target.closest('.ver-comentarios-anteriores');
+        if (!boton || boton.disabled) return;
+        const coleccion = boton.dataset.coleccion;
+        boton.disabled = true;
+        fetch(`/comentarios/${coleccion}/${boton.dataset.padre}?antes=${boton.dataset.antes}`)
+            .then(res => res.json())
+            .then(data => {
+                const fragmento = document.createDocumentFragment();
+                (data.items || []).forEach(c => fragmento.appendChild(formatos[coleccion](c)));
+                boton.after(fragmento);
+                if (data.antes) {
+                    boton.dataset.antes = data.antes;
+                    boton.textContent = `Ver comentarios anteriores (${data.antes})`;
+                    boton.disabled = false;
+                } else {
+                    boton.remove();
+                }
+            })
+            .catch(() => { boton.disabled = false; });
+    });
+})();
@@ -1,4 +1,4 @@
-let offset = 0;
+let cursor = null;
 let isScrolling = false;
 
 $(document).ready(function() {
@@ -35,6 +35,8 @@ $(document).ready(function() {
             contentType: false,
             success: function(response) {
                 if (response.success) {
+                    // puede haber llegado antes por el feed en tiempo real
+                    $("#" + $($.parseHTML(response.html)).filter(".confesion-card").attr("id")).remove();
                     contenedorConfesiones.prepend(response.html);
                     formConfesion[0].reset();
                     modal.hide();
@@ -46,6 +48,16 @@ $(document).ready(function() {
         });
     });
 
+    // Confesiones nuevas de otros usuarios en tiempo real
+    if (window.hqSocket) {
+        hqUnirse({ feed: "confesiones" });
+        hqSocket.on("nueva_confesion", function(data) {
+            if (!document.getElementById("conf-" + data.id)) {
+                contenedorConfesiones.prepend(data.html);
+            }
+        });
+    }
+
     // Delegación de eventos para elementos dinámicos
     // Esto es más eficiente y funciona para el scroll infinito.
     
@@ -132,11 +144,12 @@ $(document).ready(function() {
     // Filtros
     $(".filters").on("click", ".btn-filter", function() {
         const tipo = $(this).data("filter-type");
-        offset = 0;
+        cursor = null;
         contenedorConfesiones.empty();
         loadingMessage.show();
         $.get(`/confesiones/filtro/${tipo}`, function(data) {
             contenedorConfesiones.html(data.html);
+            cursor = data.next_cursor;
             loadingMessage.hide();
         }).fail(() => {
             loadingMessage.hide();
@@ -146,12 +159,13 @@ $(document).ready(function() {
 
     // Carga infinita
     function cargarMasConfesiones() {
-        if (isScrolling) return;
+        if (isScrolling || cursor === null) return;
         isScrolling = true;
         loadingMessage.show();
-        $.get("/confesiones_scroll", { offset: offset }, function(data) {
+        const params = cursor ? { cursor: cursor } : {};
+        $.get("/confesiones_scroll", params, function(data) {
             contenedorConfesiones.append(data.html);
-            offset += data.count;
+            cursor = data.next_cursor;
             isScrolling = false;
             loadingMessage.hide();
         });
@@ -163,8 +177,10 @@ $(document).ready(function() {
         }
     });
 
-    // Cargar las confesiones iniciales si no hay ninguna
+    // El servidor ya pinta la primera página; su cursor viene en data-cursor
+    cursor = contenedorConfesiones.attr("data-cursor") || null;
     if (contenedorConfesiones.children().length === 0) {
+        cursor = "";
         cargarMasConfesiones();
     }
 });
\ No newline at end of file